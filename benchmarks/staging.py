@@ -0,0 +1,344 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from types import SimpleNamespace
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+import kernelci  # noqa: E402
+
+SCRIPTS = ['pending', 'update', 'kernel']
+
+NAMESPACE = 'bench'
+USER = 'bench'
+STAGING_BRANCH = 'staging.kernelci.org'
+PRODUCTION_BRANCH = 'kernelci.org'
+COMMITTER = 'Bench <bench@example.com>'
+
+
+class FakeGithub:
+    """Stand-in for the PyGithub client with local repositories"""
+
+    def __init__(self):
+        self._repos = {}
+
+    def add_repo(self, name, path, pulls):
+        self._repos[name] = SimpleNamespace(
+            full_name=name, clone_url=path, ssh_url=path,
+            get_pulls=lambda: list(reversed(pulls)),
+        )
+
+    def get_repo(self, name):
+        return self._repos[name]
+
+
+def fake_pull(number, path, branch, sha):
+    fork = SimpleNamespace(clone_url=path, owner=SimpleNamespace(login=USER))
+    return SimpleNamespace(
+        number=number, labels=[],
+        head=SimpleNamespace(ref=branch, repo=fork, sha=sha),
+        base=SimpleNamespace(ref='main'),
+    )
+
+
+def data(text):
+    return 'data {}\n{}\n'.format(len(text), text)
+
+
+def commit(ref, mark, parent, msg, files, when):
+    cmds = [
+        'commit {}\n'.format(ref),
+        'mark :{}\n'.format(mark),
+        'committer {} {} +0000\n'.format(COMMITTER, when),
+        data(msg),
+    ]
+    if parent:
+        cmds.append('from :{}\n'.format(parent))
+    for path, content in files:
+        cmds.append('M 100644 inline {}\n'.format(path))
+        cmds.append(data(content))
+    cmds.append('\n')
+    return cmds
+
+
+def reset(ref, mark):
+    return ['reset {}\nfrom :{}\n\n'.format(ref, mark)]
+
+
+def make_upstream(path, args, tag_prefix):
+    """Create a bare repository with a base tree, PR branches and tags"""
+    subprocess.run(['git', 'init', '--quiet', '--bare', path], check=True)
+    when = 1577836800
+    base_files = [
+        ('files/{:04}/{:04}.txt'.format(i // 100, i), 'file {}\n'.format(i))
+        for i in range(args.files)
+    ]
+    base_files.append(('shared.txt', 'base\n'))
+    cmds = commit('refs/heads/{}'.format(STAGING_BRANCH), 1, None,
+                  "Base", base_files, when)
+    cmds += commit('refs/heads/{}'.format(PRODUCTION_BRANCH), 2, 1,
+                   "Production", [('production.txt', 'production\n')], when)
+    cmds += commit('refs/heads/main', 3, 1,
+                   "Main", [('main.txt', 'main\n')], when + 1)
+    pulls = []
+    for number in range(1, args.prs + 1):
+        files = [('pulls/{}.txt'.format(number), 'PR {}\n'.format(number))]
+        if number <= args.conflicts:
+            files.append(('shared.txt', 'PR {}\n'.format(number)))
+        branch = 'pr-{}'.format(number)
+        mark = 100 + number
+        cmds += commit('refs/heads/{}'.format(branch), mark, 3,
+                       "PR {}".format(number), files, when + 2)
+        cmds += reset('refs/pull/{}/head'.format(number), mark)
+        pulls.append((number, branch))
+    day = datetime.date(2020, 1, 1)
+    for i in range(args.tags):
+        tag = '{}{}.0'.format(tag_prefix, (day + datetime.timedelta(i))
+                              .strftime('%Y%m%d'))
+        cmds += reset('refs/tags/{}'.format(tag), 1)
+    subprocess.run(['git', '-C', path, 'fast-import', '--quiet'],
+                   input=''.join(cmds).encode(), check=True)
+    return [
+        fake_pull(number, path, branch, subprocess.check_output(
+            ['git', '-C', path, 'rev-parse', branch]).decode().strip())
+        for number, branch in pulls
+    ]
+
+
+def make_patches(path, count):
+    os.makedirs(path)
+    for i in range(1, count + 1):
+        name = 'patches/{}.txt'.format(i)
+        with open(os.path.join(path, '{:04}-patch.patch'.format(i)), 'w') as f:
+            f.write("""\
+From 0000000000000000000000000000000000000000 Mon Sep 17 00:00:00 2001
+From: {committer}
+Date: Wed, 1 Jan 2020 00:00:00 +0000
+Subject: [PATCH] Add patch {i}
+
+---
+diff --git a/{name} b/{name}
+new file mode 100644
+--- /dev/null
++++ b/{name}
+@@ -0,0 +1 @@
++patch {i}
+--
+2.30.0
+
+""".format(committer=COMMITTER, i=i, name=name))
+
+
+def setup(work, args, github):
+    """Create one working directory and repository for each script"""
+    os.makedirs(work, exist_ok=True)
+    key = os.path.join(work, 'id_bench')
+    subprocess.run(['ssh-keygen', '-q', '-t', 'ed25519', '-N', '', '-f', key],
+                   check=True)
+    scripts = {}
+    for script in args.scripts:
+        path = os.path.join(work, script)
+        os.makedirs(path)
+        upstream = os.path.join(path, 'upstream.git')
+        if script == 'pending':
+            project = 'kernelci-core'
+            pulls = make_upstream(upstream, args, 'staging-')
+            with open(os.path.join(path, 'staging.ini'), 'w') as f:
+                f.write("[DEFAULT]\nusers: {}\n\n[{}]\n".format(USER, project))
+            make_patches(os.path.join(path, 'patches', project,
+                                      STAGING_BRANCH), args.patches)
+            script_args = argparse.Namespace(
+                project=project, settings='staging.ini', namespace=NAMESPACE,
+                branch=STAGING_BRANCH, main='main', skip=[],
+                skip_label='staging-skip', tag=None, tag_prefix='staging-',
+                tag_limit=args.tags, jobs=4, token=None, diff_only=False,
+                conflicts=False)
+        elif script == 'update':
+            project = 'kernelci-api'
+            pulls = make_upstream(upstream, args, 'kernelci-')
+            script_args = argparse.Namespace(
+                project=project, namespace=NAMESPACE,
+                branch=PRODUCTION_BRANCH, origin='origin',
+                origin_branch='main', tag=None, tag_prefix='kernelci-')
+        else:
+            project = 'linux'
+            pulls = make_upstream(upstream, args, 'staging-')
+            make_patches(os.path.join(path, 'patches', project,
+                                      STAGING_BRANCH), args.patches)
+            script_args = argparse.Namespace(
+                project=project, namespace=NAMESPACE, branch=STAGING_BRANCH,
+                from_url=upstream, from_branch='main', tag=None,
+                tag_prefix='staging-', tag_limit=args.tags)
+        github.add_repo('/'.join([NAMESPACE, project]), upstream, pulls)
+        vars(script_args).update(
+            ssh_key=key, push=True, diffstat=True,
+            cache_dir=args.cache_dir, clone_filter=None)
+        scripts[script] = (path, script_args)
+    return scripts
+
+
+@contextlib.contextmanager
+def quiet(verbose):
+    if verbose:
+        yield
+        return
+    sys.stdout.flush()
+    sys.stderr.flush()
+    saved = os.dup(2)
+    devnull = os.open(os.devnull, os.O_WRONLY)
+    os.dup2(devnull, 2)
+    try:
+        with contextlib.redirect_stdout(io.StringIO()):
+            yield
+    finally:
+        os.dup2(saved, 2)
+        os.close(saved)
+        os.close(devnull)
+
+
+def run(script, path, script_args, verbose):
+    module = __import__(script)
+    cwd = os.getcwd()
+    kernelci.REPORT.reset()
+    start = time.time()
+    try:
+        os.chdir(path)
+        with quiet(verbose):
+            ret = module.main(script_args)
+    finally:
+        os.chdir(cwd)
+    duration = time.time() - start
+    report = kernelci.REPORT.to_dict()
+    return {
+        'script': script,
+        'success': ret is True,
+        'duration': duration,
+        'phases': report['phases'],
+        'commands': len(report['commands']),
+    }
+
+
+def summarise(runs):
+    """Cold (first) run and median of the warm runs for each measurement"""
+    def median(values):
+        return statistics.median(values) if values else None
+
+    rows = [('total', runs[0]['duration'],
+             median([res['duration'] for res in runs[1:]]))]
+    phases = sorted(set(name for res in runs for name in res['phases']))
+    for name in phases:
+        rows.append((name, runs[0]['phases'].get(name, 0), median([
+            res['phases'].get(name, 0) for res in runs[1:]])))
+    return rows
+
+
+def main(args):
+    os.environ.pop('GITHUB_TOKEN', None)
+    for var in ['AUTHOR', 'COMMITTER']:
+        os.environ['GIT_{}_NAME'.format(var)] = 'Bench'
+        os.environ['GIT_{}_EMAIL'.format(var)] = 'bench@example.com'
+    github = kernelci.GITHUB = FakeGithub()
+
+    work = args.work_dir or tempfile.mkdtemp(prefix='kernelci-bench-')
+    results = []
+    try:
+        start = time.time()
+        scripts = setup(work, args, github)
+        setup_time = time.time() - start
+        for script in args.scripts:
+            path, script_args = scripts[script]
+            results.append([
+                run(script, path, script_args, args.verbose)
+                for _ in range(args.runs)
+            ])
+    finally:
+        if not args.keep:
+            shutil.rmtree(work, ignore_errors=True)
+
+    if args.json:
+        print(json.dumps({'setup': setup_time, 'runs': results}, indent=2))
+        return all(res['success'] for runs in results for res in runs)
+
+    print("Setup: {:.3f}s ({} PRs, {} files, {} patches, {} tags)".format(
+        setup_time, args.prs, args.files, args.patches, args.tags))
+    print("\n{:10} {:12} {:>10} {:>10}".format(
+        "Script", "Phase", "Cold (s)", "Warm (s)"))
+    print("-------------------------------------------------------------")
+    ret = True
+    for runs in results:
+        failed = [i for i, res in enumerate(runs) if not res['success']]
+        ret = ret and not failed
+        script = runs[0]['script']
+        for name, cold, warm in summarise(runs):
+            print("{:10} {:12} {:10.3f} {:>10}".format(
+                script, name, cold,
+                '-' if warm is None else '{:.3f}'.format(warm)))
+            script = ''
+        if failed:
+            print("{:10} FAILED runs: {}".format('', failed))
+    return ret
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("\
+Time the staging scripts end to end with synthetic local repositories")
+    parser.add_argument("scripts", nargs='*', default=SCRIPTS,
+                        help="Scripts to run: pending, update or kernel")
+    parser.add_argument("--prs", type=int, default=50,
+                        help="Number of PR branches")
+    parser.add_argument("--conflicts", type=int, default=3,
+                        help="Number of PRs changing the same file")
+    parser.add_argument("--files", type=int, default=1000,
+                        help="Number of files in the base tree")
+    parser.add_argument("--patches", type=int, default=5,
+                        help="Number of patches to apply")
+    parser.add_argument("--tags", type=int, default=20,
+                        help="Number of existing tags, also the tag limit")
+    parser.add_argument("--runs", type=int, default=3,
+                        help="Number of runs, the first one is cold")
+    parser.add_argument("--cache-dir",
+                        help="Path to a shared git object cache")
+    parser.add_argument("--work-dir",
+                        help="Directory to create the repositories in, \
+default is a temporary directory")
+    parser.add_argument("--keep", action="store_true",
+                        help="Keep the working directory")
+    parser.add_argument("--verbose", action="store_true",
+                        help="Show the output of the scripts")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the results as JSON")
+    args = parser.parse_args(sys.argv[1:])
+    for script in args.scripts:
+        if script not in SCRIPTS:
+            parser.error("invalid script: {}".format(script))
+    ret = main(args)
+    sys.exit(0 if ret is True else 1)
@@ -0,0 +1,104 @@
+#!/usr/bin/env python3
+#
+# Copyright (C) 2019 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+ENTRY_POINTS = [
+    'pending.py',
+    'update.py',
+    'kernel.py',
+    'job.py',
+]
+
+
+def parse_importtime(output):
+    total = 0
+    top_level = {}
+    for line in output.splitlines():
+        if not line.startswith('import time:') or 'self [us]' in line:
+            continue
+        self_us, cumulative, name = line[len('import time:'):].split('|')
+        total += int(self_us)
+        if not name[1:].startswith(' '):
+            top_level[name.strip()] = int(cumulative)
+    return total, top_level
+
+
+def measure(script, runs):
+    walls = []
+    imports = []
+    top_level = {}
+    for _ in range(runs):
+        start = time.time()
+        res = subprocess.run(
+            [sys.executable, '-X', 'importtime', script, '--help'],
+            cwd=ROOT, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+        walls.append(time.time() - start)
+        total, top_level = parse_importtime(res.stderr.decode())
+        imports.append(total / 1e6)
+    slowest = sorted(top_level.items(), key=lambda item: -item[1])[:5]
+    return {
+        'script': script,
+        'status': res.returncode,
+        'wall': statistics.median(walls),
+        'imports': statistics.median(imports),
+        'slowest': [
+            {'module': name, 'cumulative': us / 1e6} for name, us in slowest
+        ],
+    }
+
+
+def main(args):
+    results = [measure(script, args.runs) for script in args.scripts]
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return True
+    print("{:12} {:>10} {:>10}  {}".format(
+        "Script", "Wall (s)", "Import (s)", "Slowest imports"))
+    print("-------------------------------------------------------------")
+    for res in results:
+        slowest = ', '.join(
+            "{} {:.3f}".format(item['module'], item['cumulative'])
+            for item in res['slowest'][:3])
+        print("{:12} {:10.3f} {:10.3f}  {}{}".format(
+            res['script'], res['wall'], res['imports'], slowest,
+            "" if res['status'] == 0 else " (exit {})".format(res['status'])))
+    return True
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser("\
+Measure the start-up time of each entry point with python -X importtime")
+    parser.add_argument("scripts", nargs='*', default=ENTRY_POINTS,
+                        help="Entry points to measure, relative to the root")
+    parser.add_argument("--runs", type=int, default=5,
+                        help="Number of runs, the median is reported")
+    parser.add_argument("--json", action="store_true",
+                        help="Print the results as JSON")
+    args = parser.parse_args(sys.argv[1:])
+    ret = main(args)
+    sys.exit(0 if ret is True else 1)
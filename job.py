@@ -18,7 +18,6 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import argparse
-import jenkins
 import json
 import sys
 import time
@@ -121,6 +120,7 @@ def main(args):
         print("Missing info: url, user and token are required")
         return False
 
+    import jenkins
     api = jenkins.Jenkins(url, user, token)
     cmd = "_".join(["cmd", args.action])
     globals()[cmd](args, api)
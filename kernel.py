@@ -22,17 +22,17 @@ import os
 import sys
 
 import kernelci
-from kernelci import print_color, shell_cmd
+from kernelci import print_color
 
 
+@kernelci.REPORT.phase('commit')
 def add_date_commit(path, msg, fname):
     with open(os.path.join(path, fname), 'w') as f:
         f.write(msg)
-    shell_cmd("""
-cd {path}
-git add {fname}
-git commit --author='"kernelci.org bot" <bot@kernelci.org>' -am {msg}
-""".format(path=path, fname=fname, msg=msg))
+    git = kernelci.git_repo(path)
+    git.run('add', fname)
+    git.run('commit', '--author="kernelci.org bot" <bot@kernelci.org>',
+            '-am', msg)
 
 
 def main(args):
@@ -40,9 +40,12 @@ def main(args):
     print("path: {}".format(path))
     repo_name = '/'.join([args.namespace, args.project])
     print("repo: {}".format(repo_name))
-    repo = kernelci.GITHUB.get_repo(repo_name)
+    with kernelci.REPORT.phase('github'):
+        repo = kernelci.GITHUB.get_repo(repo_name)
     print("checking out {} {}".format(args.from_url, args.from_branch))
-    kernelci.checkout_repository(path, repo, args.from_url, args.from_branch)
+    kernelci.checkout_repository(path, repo, args.from_url, args.from_branch,
+                                 cache_dir=args.cache_dir,
+                                 clone_filter=args.clone_filter)
     patches_path = os.path.join('patches', args.project, args.branch)
     print("patches: {}".format(patches_path))
     if not kernelci.apply_patches(path, patches_path):
@@ -83,10 +86,28 @@ Create a kernel branch to test KernelCI")
                         help="Github project namespace")
     parser.add_argument("--project", default='linux',
                         help="Name of the Github project")
+    parser.add_argument("--token",
+                        help="Github token to authenticate API requests, \
+default is to use GITHUB_TOKEN if set")
     parser.add_argument("--ssh-key",
                         help="Path to SSH key to push branches and tags")
+    parser.add_argument("--cache-dir",
+                        help="Path to a shared git object cache")
+    parser.add_argument("--clone-filter",
+                        help="Partial clone filter, for example blob:none")
     parser.add_argument("--push", action="store_true",
                         help="Push the resulting branch and tag")
+    parser.add_argument("--report",
+                        help="Path to write the JSON timing report to")
+    parser.add_argument("--prometheus",
+                        help="Path to write a Prometheus textfile report to")
     args = parser.parse_args(sys.argv[1:])
-    ret = main(args)
+    if args.token:
+        kernelci.GITHUB_TOKEN = args.token
+    kernelci.REPORT.labels.update(script='kernel', project=args.project)
+    ret = False
+    try:
+        ret = main(args)
+    finally:
+        kernelci.REPORT.write(args.report, args.prometheus, ret is True)
     sys.exit(0 if ret is True else 1)
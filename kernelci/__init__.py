@@ -15,12 +15,21 @@
 # along with this library; if not, write to the Free Software Foundation, Inc.,
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
+import atexit
 import configparser
 import datetime
-import github
+import hashlib
+import json
 import os
 import re
 import subprocess
+import sys
+import threading
+import time
+
+from kernelci.git import Git
+from kernelci.report import REPORT
+from kernelci.ssh import SshSession
 
 # Mainline kernel URL from torvalds
 TORVALDS_GIT_URL = \
@@ -35,16 +44,49 @@ COLORS = {
     'clear': '\033[0m',
 }
 
-# Github API handler
-GITHUB = github.Github()
+# Directory where Github API responses are cached
+GITHUB_CACHE = os.path.join(os.path.dirname(__file__), '.cache', 'github')
+
+# Github token for the API handler, replies to conditional requests are only
+# exempt from the rate limit when authenticated
+GITHUB_TOKEN = os.environ.get('GITHUB_TOKEN')
+
+# Git repositories already opened, by path
+_GIT_REPOS = {}
+
+# SSH sessions already started, by SSH key
+_SSH_SESSIONS = {}
+
+# Lock for the registries above when running several projects concurrently
+_REGISTRY_LOCK = threading.Lock()
+
+
+def __getattr__(name):
+    # The Github API handler is only created when first used as importing
+    # PyGithub takes much longer than everything else
+    if name == 'GITHUB':
+        import github
+        from kernelci import github_cache
+        github_cache.install(GITHUB_CACHE)
+        auth = github.Auth.Token(GITHUB_TOKEN) if GITHUB_TOKEN else None
+        client = globals()['GITHUB'] = github.Github(auth=auth)
+        return client
+    raise AttributeError(
+        "module {!r} has no attribute {!r}".format(__name__, name))
 
 
 def print_color(color, msg):
     print(''.join([COLORS[color], msg, COLORS['clear']]))
 
 
-def shell_cmd(cmd):
-    return subprocess.check_output(cmd, shell=True).decode()
+def git_repo(path):
+    key = os.path.abspath(path)
+    with _REGISTRY_LOCK:
+        repo = _GIT_REPOS.get(key)
+        if repo is None:
+            repo = _GIT_REPOS[key] = Git(path)
+            atexit.register(repo.close)
+    return repo
 
 
 def default_ssh_key(ssh_key, branch):
@@ -59,71 +101,50 @@ def default_ssh_key(ssh_key, branch):
     return None
 
 
-def ssh_agent(ssh_key, cmd):
-    if ssh_key:
-        cmd = "ssh-agent sh -c 'ssh-add {key}; {cmd}'".format(
-            key=ssh_key, cmd=cmd)
-    shell_cmd(cmd)
+def ssh_session(ssh_key):
+    with _REGISTRY_LOCK:
+        session = _SSH_SESSIONS.get(ssh_key)
+        if session is None:
+            session = _SSH_SESSIONS[ssh_key] = SshSession(ssh_key)
+            atexit.register(session.close)
+    return session
 
 
+@REPORT.phase('tag')
 def date_tag(path, px, fmt="%Y%m%d"):
     tag_name = "{}{}".format(px, datetime.date.today().strftime(fmt))
-    try:
-        n = int(shell_cmd("""
-cd {path}
-git fetch --quiet --tags origin
-git tag -l | grep -c {tag}
-""".format(path=path, tag=tag_name)))
-    except subprocess.CalledProcessError:
-        n = 0
+    n = len(git_repo(path).tags.list(tag_name))
     tag_name = '.'.join([tag_name, str(n)])
     return tag_name
 
 
+@REPORT.phase('tag')
 def create_tag(path, tag):
-    shell_cmd("""\
-cd {path}
-git tag -l | grep {tag} && git tag -d {tag}
-git tag -a {tag} -m {tag}
-""".format(path=path, tag=tag))
+    git_repo(path).run('tag', '--force', '-a', tag, '-m', tag)
     return tag
 
 
-def list_tags(path, pattern='^.*'):
-    shell_cmd("""\
-cd {path}
-git tag -l | grep -e '{pattern}' | xargs git tag -d
-git fetch -q --tags origin
-""".format(path=path, pattern=pattern))
-    cmd = "cd {path}; git tag -l | grep -e '{pattern}'".format(
-        path=path, pattern=pattern
-    )
-    tags = sorted(shell_cmd(cmd).split())
-    return tags
+@REPORT.phase('tag')
+def list_tags(path, prefix=''):
+    return git_repo(path).tags.list(prefix)
 
 
+@REPORT.phase('tag')
 def delete_tags(path, tags, ssh_key):
-    slices = []
-    index = 0
-    n_tags = len(tags)
-    slice_max_len = 100
-    while index != n_tags:
-        slice_len = min((n_tags - index), slice_max_len)
-        slices.append(tags[index:index+slice_len])
-        index += slice_len
-    for tags_slice in slices:
-        tags_str = ' '.join(tags_slice)
-        print("Deleting {}".format(tags_str))
-        cmd = "cd {}; echo {} | xargs git tag -d".format(path, tags_str)
-        shell_cmd(cmd)
-        tags_push_str = ' :'.join(tags_slice)
-        cmd = "cd {}; echo :{} | xargs git push origin".format(
-            path, tags_push_str)
-        ssh_agent(ssh_key, cmd)
+    start = time.time()
+    git = git_repo(path)
+    git.run('push', '--quiet', '--atomic', 'origin',
+            *(':refs/tags/{}'.format(tag) for tag in tags),
+            env=ssh_session(ssh_key).env)
+    git.update_refs('delete refs/tags/{}'.format(tag) for tag in tags)
+    git.tags.remove(tags)
+    duration = time.time() - start
+    print("Deleted {} tags in {:.2f}s ({:.1f} tags/s)".format(
+        len(tags), duration, len(tags) / duration if duration else 0))
 
 
 def delete_old_tags(args, path, ssh_key):
-    tags = list_tags(path, args.tag_prefix + "*")
+    tags = list_tags(path, args.tag_prefix)
     if len(tags) > args.tag_limit:
         limit = args.tag_limit * -1
         to_delete = tags[:limit]
@@ -133,37 +154,95 @@ def delete_old_tags(args, path, ssh_key):
         delete_tags(path, to_delete, ssh_key)
 
 
-def checkout_repository(path, repo, origin="origin", branch="main"):
+def object_cache(url, cache_dir):
+    name = re.sub(r'[^\w.-]+', '_', url.rstrip('/'))
+    if not name.endswith('.git'):
+        name += '.git'
+    path = os.path.join(cache_dir, name)
     if not os.path.exists(path):
-        shell_cmd("""\
-git clone {url} {path}
-cd {path}
-git remote set-url --push origin {push}
-""".format(path=path, url=repo.clone_url, push=repo.ssh_url))
-
-    shell_cmd("""\
-cd {path}
-git reset --quiet --hard --merge
-git fetch --quiet {origin} {branch}
-git checkout FETCH_HEAD
-git config user.name "kernelci.org bot"
-git config user.email "bot@kernelci.org"
-""".format(path=path, origin=origin, branch=branch))
-
-
-def origin_diff(path, branch):
-    shell_cmd("""\
-cd {path}
-git remote update origin
-""".format(path=path))
-    diff = shell_cmd("""\
-cd {path}
-git diff origin/{branch}..HEAD
-""".format(path=path, branch=branch))
-    return diff
-
-
-def _find_patches(path):
+        Git.clone(url, path, '--bare')
+    else:
+        git_repo(path).run('fetch', '--quiet', url,
+                           '+refs/heads/*:refs/heads/*',
+                           '+refs/tags/*:refs/tags/*')
+    # Checkouts borrow objects from the cache which may no longer be
+    # reachable from its refs after forced updates, so never prune them
+    git = git_repo(path)
+    git.run('config', 'gc.auto', '0')
+    git.run('config', 'gc.pruneExpire', 'never')
+    return os.path.abspath(path)
+
+
+def _add_alternate(path, cache_path):
+    alternates = os.path.join(path, '.git', 'objects', 'info', 'alternates')
+    objects = os.path.join(cache_path, 'objects')
+    if os.path.exists(alternates):
+        with open(alternates) as alt_file:
+            if objects in alt_file.read().split():
+                return
+    with open(alternates, 'a') as alt_file:
+        alt_file.write('{}\n'.format(objects))
+
+
+@REPORT.phase('checkout')
+def fetch_repository(path, repo, origin="origin", branch="main",
+                     cache_dir=None, clone_filter=None, checkout=True):
+    if not os.path.exists(path):
+        opts = []
+        if cache_dir:
+            opts += ['--reference', object_cache(repo.clone_url, cache_dir)]
+        if clone_filter:
+            opts += ['--filter={}'.format(clone_filter)]
+        if not checkout:
+            opts.append('--no-checkout')
+        git = Git.clone(repo.clone_url, path, *opts)
+        git.run('remote', 'set-url', '--push', 'origin', repo.ssh_url)
+        with _REGISTRY_LOCK:
+            _GIT_REPOS[os.path.abspath(path)] = git
+        atexit.register(git.close)
+        if cache_dir and origin not in ('origin', repo.clone_url):
+            _add_alternate(path, object_cache(origin, cache_dir))
+
+    git = git_repo(path)
+    git.run('config', 'user.name', 'kernelci.org bot')
+    git.run('config', 'user.email', 'bot@kernelci.org')
+    git.run('fetch', '--quiet', origin, branch)
+    return git.rev_parse('FETCH_HEAD')
+
+
+@REPORT.phase('checkout')
+def checkout_repository(path, repo, origin="origin", branch="main",
+                        cache_dir=None, clone_filter=None):
+    fetch_repository(path, repo, origin, branch, cache_dir, clone_filter)
+    git = git_repo(path)
+    git.run('reset', '--quiet', '--hard', '--merge')
+    git.run('checkout', '--quiet', 'FETCH_HEAD')
+
+
+@REPORT.phase('diff')
+def origin_changed(path, branch, rev='HEAD'):
+    git = git_repo(path)
+    git.run('remote', 'update', 'origin')
+    origin_tree = git.rev_parse('origin/{}^{{tree}}'.format(branch))
+    return origin_tree != git.rev_parse('{}^{{tree}}'.format(rev))
+
+
+@REPORT.phase('diff')
+def print_origin_diff(path, branch, stat=False, rev='HEAD'):
+    git = git_repo(path)
+    origin = 'origin/{}'.format(branch)
+    if not git.rev_parse(origin):
+        print("No {} branch to compare with".format(origin))
+        return
+    diff = ['--no-pager', 'diff', '--stat' if stat else '--patch', origin, rev]
+    if sys.stdout is sys.__stdout__:
+        sys.stdout.flush()
+        git.run(*diff, capture=False)
+    else:
+        print(git.run(*diff), end='')
+
+
+def find_patches(path):
     patches_re = re.compile('.*\.(patch|mbx)$')
     for root, dirs, files in os.walk(path):
         for file_name in files:
@@ -171,29 +250,76 @@ def _find_patches(path):
                 yield os.path.join(root, file_name)
 
 
+def patches_digest(patches_path):
+    digest = hashlib.sha256()
+    for patch in sorted(find_patches(patches_path)):
+        with open(patch, 'rb') as patch_file:
+            digest.update(hashlib.sha256(patch_file.read()).digest())
+    return digest.hexdigest()
+
+
+def preflight_patches(path, patches, rev='HEAD'):
+    n = git_repo(path).apply_check(rev, (data for _, data in patches))
+    return None if n is None else patches[n][0]
+
+
+@REPORT.phase('patches')
 def apply_patches(path, patches_path):
-    patches = list(sorted(_find_patches(patches_path)))
-    for patch in patches:
-        print("Applying patch: {}".format(patch))
-        try:
-            shell_cmd("""\
-cat {patch} | (cd {path} && git am)
-""".format(path=path, patch=patch))
-        except subprocess.CalledProcessError:
-            print("WARNING: Failed to apply patch")
-            shell_cmd("""\
-cd {path}
-git am --abort
-""".format(path=path))
-            return False
+    git = git_repo(path)
+    patches = []
+    for patch in sorted(find_patches(patches_path)):
+        with open(patch, 'rb') as patch_file:
+            patches.append((patch, patch_file.read()))
+    if not patches:
+        return True
+
+    cache = JsonCache(os.path.join(git.git_dir, 'kernelci-patches.json'))
+    head = git.rev_parse('HEAD')
+    cached = 0
+    for patch, patch_data in patches:
+        key = ':'.join([head, hashlib.sha256(patch_data).hexdigest()])
+        commit = cache.get(key)
+        if not commit or not git.rev_parse(commit):
+            break
+        print("Reusing patch: {}".format(patch))
+        head = commit
+        cached += 1
+    if cached:
+        git.run('reset', '--quiet', '--hard', head)
+    patches = patches[cached:]
+
+    failed = preflight_patches(path, patches, head)
+    if failed:
+        print("WARNING: Patch does not apply: {}".format(failed))
+        return False
+
+    try:
+        for patch, patch_data in patches:
+            print("Applying patch: {}".format(patch))
+            try:
+                git.run('am', stdin=patch_data)
+            except subprocess.CalledProcessError:
+                print("WARNING: Failed to apply patch")
+                git.run('am', '--abort')
+                return False
+            key = ':'.join([head, hashlib.sha256(patch_data).hexdigest()])
+            head = git.rev_parse('HEAD')
+            cache.set(key, head)
+    finally:
+        cache.save()
     return True
 
 
+@REPORT.phase('push')
 def push_tag_and_branch(path, ssh_key, branch, tag):
-    ssh_agent(ssh_key, """\
-cd {path}
-git push --quiet --force origin HEAD:{branch} {tag}
-""".format(path=path, branch=branch, tag=(tag or '')))
+    git = git_repo(path)
+    refs = ['HEAD:{}'.format(branch)]
+    if tag:
+        refs.append(tag)
+    git.run('push', '--quiet', '--force', 'origin', *refs,
+            env=ssh_session(ssh_key).env)
+    if tag:
+        git.tags.add(tag, git.rev_parse('refs/tags/{}'.format(tag)))
 
 
 class Settings:
@@ -204,6 +330,9 @@ class Settings:
             self._settings.read(path)
         self._section = section
 
+    def sections(self):
+        return self._settings.sections()
+
     def get(self, option, as_list=False):
         if not self._settings.has_option(self._section, option):
             return None
@@ -211,3 +340,35 @@ class Settings:
         if not as_list and len(value) == 1:
             value = value[0]
         return value
+
+
+class JsonCache:
+
+    def __init__(self, path, max_entries=1000):
+        self._path = path
+        self._max_entries = max_entries
+        self._data = {}
+        if path and os.path.exists(path):
+            with open(path) as cache_file:
+                self._data = json.load(cache_file)
+
+    def get(self, key):
+        value = self._data.pop(key, None)
+        if value is not None:
+            # Move the entry to the end so the least recently used go first
+            self._data[key] = value
+        return value
+
+    def set(self, key, value):
+        self._data.pop(key, None)
+        self._data[key] = value
+        while len(self._data) > self._max_entries:
+            del self._data[next(iter(self._data))]
+
+    def save(self):
+        if not self._path:
+            return
+        tmp = '.'.join([self._path, 'tmp'])
+        with open(tmp, 'w') as cache_file:
+            json.dump(self._data, cache_file, indent=2)
+        os.replace(tmp, self._path)
@@ -0,0 +1,193 @@
+# Copyright (C) 2019 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import contextlib
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+from kernelci.report import REPORT
+
+
+class Git:
+    """Git commands run directly in one repository, without a shell
+
+    Object and revision lookups go through a single long-lived
+    `git cat-file --batch-check` process and ref updates are sent as one
+    `git update-ref --stdin` transaction, so callers can look up or update
+    many objects without spawning a process for each of them.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        self._cat_file = None
+        self._lock = threading.Lock()
+        self._tags = None
+        self._git_dir = None
+
+    @property
+    def path(self):
+        return self._path
+
+    @property
+    def git_dir(self):
+        if self._git_dir is None:
+            self._git_dir = self.run('rev-parse', '--absolute-git-dir').strip()
+        return self._git_dir
+
+    @property
+    def tags(self):
+        if self._tags is None:
+            self._tags = TagIndex(self)
+        return self._tags
+
+    @classmethod
+    def _call(cls, cmd, stdin=None, env=None, capture=True):
+        # Keep stderr with the rest of the output when sys.stderr has been
+        # redirected, for example to a buffer for each project
+        redirected = sys.stderr is not sys.__stderr__
+        start = time.time()
+        res = subprocess.run(cmd, input=stdin, env=env,
+                             stdout=subprocess.PIPE if capture else None,
+                             stderr=subprocess.PIPE if redirected else None)
+        REPORT.add_command(' '.join(cmd), time.time() - start,
+                           res.returncode, len(res.stdout) if capture else None)
+        if res.stderr:
+            sys.stderr.write(res.stderr.decode(errors='replace'))
+        res.check_returncode()
+        return res.stdout.decode() if capture else ''
+
+    @classmethod
+    def clone(cls, url, path, *opts):
+        cls._call(['git', 'clone', '--quiet'] + list(opts) + [url, path])
+        return cls(path)
+
+    def run(self, *args, stdin=None, env=None, capture=True):
+        if isinstance(stdin, str):
+            stdin = stdin.encode()
+        if env:
+            env = dict(os.environ, **env)
+        return self._call(['git', '-C', self._path] + list(args),
+                          stdin, env, capture)
+
+    def rev_parse(self, rev):
+        with self._lock:
+            if self._cat_file is None or self._cat_file.poll() is not None:
+                self._cat_file = subprocess.Popen(
+                    ['git', '-C', self._path, 'cat-file', '--batch-check'],
+                    stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+            self._cat_file.stdin.write('{}\n'.format(rev).encode())
+            self._cat_file.stdin.flush()
+            line = self._cat_file.stdout.readline().decode().split()
+        if len(line) != 3:
+            return None
+        return line[0]
+
+    def update_refs(self, commands):
+        commands = list(commands)
+        if commands:
+            self.run('update-ref', '--stdin', stdin=''.join(
+                '{}\n'.format(cmd) for cmd in commands))
+
+    @contextlib.contextmanager
+    def scratch_index(self, rev):
+        tmp = tempfile.mkdtemp(prefix='kernelci-index-')
+        env = {'GIT_INDEX_FILE': os.path.join(tmp, 'index')}
+        try:
+            self.run('read-tree', rev, env=env)
+            yield env
+        finally:
+            shutil.rmtree(tmp)
+
+    def apply_check(self, rev, patches):
+        """Return the index of the first patch of a series not applying to rev
+
+        Each patch is applied to a scratch index on top of the previous
+        ones, so None means the whole series applies.
+        """
+        with self.scratch_index(rev) as env:
+            for n, patch in enumerate(patches):
+                try:
+                    self.run('apply', '--cached', stdin=patch, env=env)
+                except subprocess.CalledProcessError:
+                    return n
+        return None
+
+    def merge_tree(self, ours, theirs):
+        try:
+            out = self.run('merge-tree', '--write-tree', '--no-messages',
+                           ours, theirs)
+        except subprocess.CalledProcessError as e:
+            if e.returncode == 1:
+                return None
+            raise
+        return out.split()[0]
+
+    def commit_tree(self, tree, parents, msg):
+        args = ['commit-tree', tree, '-m', msg]
+        for parent in parents:
+            args += ['-p', parent]
+        return self.run(*args).strip()
+
+    def refs(self, prefix):
+        out = self.run('for-each-ref', '--format=%(refname)', prefix)
+        return out.split()
+
+    def close(self):
+        if self._cat_file is not None:
+            self._cat_file.stdin.close()
+            self._cat_file.wait()
+            self._cat_file = None
+
+
+class TagIndex:
+    """Tags on a remote, listed with `git ls-remote` once per tag prefix
+
+    The index is then kept up to date with the tags pushed or deleted
+    during the run rather than by listing or fetching all the tags again.
+    """
+
+    def __init__(self, git, remote='origin'):
+        self._git = git
+        self._remote = remote
+        self._prefixes = set()
+        self._tags = {}
+
+    def _load(self, prefix):
+        if any(prefix.startswith(px) for px in self._prefixes):
+            return
+        out = self._git.run('ls-remote', '--tags', '--refs', self._remote,
+                            'refs/tags/{}*'.format(prefix))
+        for line in out.splitlines():
+            sha, ref = line.split('\t')
+            self._tags[ref[len('refs/tags/'):]] = sha
+        self._prefixes.add(prefix)
+
+    def list(self, prefix=''):
+        self._load(prefix)
+        return sorted(tag for tag in self._tags if tag.startswith(prefix))
+
+    def add(self, tag, sha=None):
+        self._tags[tag] = sha
+
+    def remove(self, tags):
+        for tag in tags:
+            self._tags.pop(tag, None)
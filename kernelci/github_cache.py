@@ -0,0 +1,120 @@
+# Copyright (C) 2019 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import hashlib
+import json
+import os
+
+from github.Requester import (
+    HTTPRequestsConnectionClass,
+    HTTPSRequestsConnectionClass,
+    Requester,
+)
+
+
+class ResponseCache:
+    """GitHub API responses stored on disk with their ETag"""
+
+    def __init__(self, path):
+        self._path = path
+
+    def _file_path(self, key):
+        name = hashlib.sha256(key.encode()).hexdigest()
+        return os.path.join(self._path, '{}.json'.format(name))
+
+    def get(self, key):
+        try:
+            with open(self._file_path(key)) as entry_file:
+                return json.load(entry_file)
+        except (OSError, ValueError):
+            return None
+
+    def set(self, key, etag, headers, body):
+        os.makedirs(self._path, exist_ok=True)
+        path = self._file_path(key)
+        tmp = '.'.join([path, str(os.getpid()), 'tmp'])
+        with open(tmp, 'w') as entry_file:
+            json.dump({'etag': etag, 'headers': headers, 'body': body},
+                      entry_file)
+        os.replace(tmp, path)
+
+
+class CachedResponse:
+
+    def __init__(self, headers, body):
+        self.status = 200
+        self.headers = headers
+        self._body = body
+
+    def getheaders(self):
+        return self.headers.items()
+
+    def read(self):
+        return self._body
+
+
+class CachingConnection(HTTPSRequestsConnectionClass):
+    """HTTPS connection sending conditional GET requests
+
+    Responses with an ETag are kept in the cache and sent again with
+    If-None-Match, so a 304 reply is served from the cache.  All the
+    connections also share a single requests session to keep the TLS
+    connection alive between API calls.
+    """
+
+    cache = None
+    _session = None
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        if CachingConnection._session is None:
+            CachingConnection._session = self.session
+        else:
+            self.session.close()
+            self.session = CachingConnection._session
+
+    def getresponse(self):
+        if self.cache is None or self.verb != 'GET':
+            return super().getresponse()
+
+        key = ' '.join([
+            self.host, self.url,
+            self.headers.get('Accept', ''),
+            hashlib.sha256(
+                self.headers.get('Authorization', '').encode()).hexdigest(),
+        ])
+        entry = self.cache.get(key)
+        if entry:
+            self.headers['If-None-Match'] = entry['etag']
+        response = super().getresponse()
+        headers = {k.lower(): v for k, v in response.getheaders()}
+        if response.status == 304 and entry:
+            cached_headers = dict(entry['headers'])
+            cached_headers.update(headers)
+            return CachedResponse(cached_headers, entry['body'])
+        if response.status == 200 and 'etag' in headers:
+            self.cache.set(key, headers['etag'], headers, response.read())
+        return response
+
+    def close(self):
+        pass
+
+
+def install(path):
+    CachingConnection.cache = ResponseCache(path)
+    Requester.injectConnectionClasses(
+        HTTPRequestsConnectionClass, CachingConnection)
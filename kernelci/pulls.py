@@ -0,0 +1,115 @@
+# Copyright (C) 2019 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import collections
+
+GRAPHQL_URL = 'https://api.github.com/graphql'
+
+GRAPHQL_QUERY = """\
+query($owner: String!, $name: String!, $cursor: String) {
+  repository(owner: $owner, name: $name) {
+    nameWithOwner
+    url
+    sshUrl
+    pullRequests(states: OPEN, first: 100, after: $cursor,
+                 orderBy: {field: CREATED_AT, direction: ASC}) {
+      pageInfo { hasNextPage endCursor }
+      nodes {
+        number
+        headRefName
+        headRefOid
+        baseRefName
+        headRepository { url owner { login } }
+        labels(first: 100) { nodes { name } }
+      }
+    }
+  }
+}
+"""
+
+Repository = collections.namedtuple('Repository', [
+    'full_name', 'clone_url', 'ssh_url',
+])
+
+PullRequest = collections.namedtuple('PullRequest', [
+    'number', 'user', 'branch', 'clone_url', 'sha', 'base', 'labels',
+])
+
+
+def list_pulls_rest(repo):
+    """Open PRs of a PyGithub repository, oldest first"""
+    pulls = []
+    for pr in reversed(list(repo.get_pulls())):
+        head_repo = pr.head.repo
+        pulls.append(PullRequest(
+            number=pr.number,
+            user=head_repo.owner.login if head_repo else None,
+            branch=pr.head.ref,
+            clone_url=head_repo.clone_url if head_repo else None,
+            sha=pr.head.sha,
+            base=pr.base.ref,
+            labels=list(label.name for label in pr.labels),
+        ))
+    return pulls
+
+
+def list_pulls_graphql(repo_name, token):
+    """Repository and open PRs, oldest first, with one GraphQL query
+
+    The query is repeated only when there are more than 100 open PRs.
+    """
+    import requests
+    owner, name = repo_name.split('/')
+    session = requests.Session()
+    session.headers['Authorization'] = 'Bearer {}'.format(token)
+    repo = None
+    pulls = []
+    cursor = None
+    while True:
+        resp = session.post(GRAPHQL_URL, json={
+            'query': GRAPHQL_QUERY,
+            'variables': {'owner': owner, 'name': name, 'cursor': cursor},
+        })
+        resp.raise_for_status()
+        data = resp.json()
+        if data.get('errors'):
+            raise RuntimeError("GraphQL query failed: {}".format(
+                '; '.join(error['message'] for error in data['errors'])))
+        repository = data['data']['repository']
+        if repo is None:
+            repo = Repository(
+                full_name=repository['nameWithOwner'],
+                clone_url='{}.git'.format(repository['url']),
+                ssh_url=repository['sshUrl'],
+            )
+        page = repository['pullRequests']
+        for pr in page['nodes']:
+            head_repo = pr['headRepository']
+            pulls.append(PullRequest(
+                number=pr['number'],
+                user=head_repo['owner']['login'] if head_repo else None,
+                branch=pr['headRefName'],
+                clone_url='{}.git'.format(head_repo['url'])
+                if head_repo else None,
+                sha=pr['headRefOid'],
+                base=pr['baseRefName'],
+                labels=list(label['name'] for label in pr['labels']['nodes']),
+            ))
+        if not page['pageInfo']['hasNextPage']:
+            break
+        cursor = page['pageInfo']['endCursor']
+    return repo, pulls
@@ -0,0 +1,170 @@
+# Copyright (C) 2019 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import contextlib
+import datetime
+import json
+import os
+import threading
+import time
+
+
+class RunReport:
+    """Timings of the commands and phases of one run
+
+    Every command records its wall time, exit status and size of output
+    along with the phase it was run in.  The report can then be written
+    as JSON and as a Prometheus textfile for node_exporter.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self.labels = {}
+        self.reset()
+
+    def reset(self):
+        """Start a new run, keeping the labels"""
+        with self._lock:
+            self._start = time.time()
+            self._commands = []
+            self._phases = {}
+            self._data = {}
+
+    @property
+    def current_phase(self):
+        return getattr(self._local, 'phase', None)
+
+    @contextlib.contextmanager
+    def phase(self, name, timed=True):
+        """Record the commands run in this thread as part of a phase
+
+        Worker threads use timed=False so their commands are recorded in
+        the phase without adding to its duration, which is already timed
+        by the thread that started them.
+        """
+        parent = self.current_phase
+        if parent == name:
+            yield
+            return
+        self._local.phase = name
+        start = time.time()
+        try:
+            yield
+        finally:
+            duration = time.time() - start
+            self._local.phase = parent
+            if timed:
+                with self._lock:
+                    self._phases[name] = self._phases.get(name, 0) + duration
+
+    def add_command(self, cmd, duration, status, output_bytes=None):
+        with self._lock:
+            self._commands.append({
+                'cmd': cmd,
+                'phase': self.current_phase,
+                'duration': round(duration, 6),
+                'status': status,
+                'bytes': output_bytes,
+            })
+
+    def set(self, key, value):
+        with self._lock:
+            self._data[key] = value
+
+    def set_item(self, key, name, value):
+        with self._lock:
+            self._data.setdefault(key, {})[name] = value
+
+    def to_dict(self, success=None):
+        with self._lock:
+            report = {
+                'labels': dict(self.labels),
+                'start': datetime.datetime.fromtimestamp(
+                    self._start, datetime.timezone.utc).isoformat(),
+                'duration': round(time.time() - self._start, 6),
+                'success': success,
+                'phases': {
+                    name: round(duration, 6)
+                    for name, duration in self._phases.items()
+                },
+                'commands': list(self._commands),
+            }
+            report.update(self._data)
+        return report
+
+    def write_json(self, path=None, success=None):
+        report = self.to_dict(success)
+        if path:
+            with open(path, 'w') as report_file:
+                json.dump(report, report_file, indent=2)
+        else:
+            print(json.dumps(report))
+
+    def write_prometheus(self, path, success=None):
+        report = self.to_dict(success)
+        labels = ','.join(
+            '{}="{}"'.format(key, value)
+            for key, value in sorted(report['labels'].items()))
+
+        def metric_labels(**extra):
+            extra = ','.join(
+                '{}="{}"'.format(key, value) for key, value in extra.items())
+            extra = ','.join(filter(None, [labels, extra]))
+            return '{{{}}}'.format(extra) if extra else ''
+
+        lines = [
+            '# TYPE kernelci_deploy_run_duration_seconds gauge',
+            'kernelci_deploy_run_duration_seconds{} {}'.format(
+                metric_labels(), report['duration']),
+            '# TYPE kernelci_deploy_run_success gauge',
+            'kernelci_deploy_run_success{} {}'.format(
+                metric_labels(), int(bool(success))),
+            '# TYPE kernelci_deploy_run_timestamp_seconds gauge',
+            'kernelci_deploy_run_timestamp_seconds{} {}'.format(
+                metric_labels(), int(self._start)),
+            '# TYPE kernelci_deploy_phase_duration_seconds gauge',
+        ]
+        for name, duration in sorted(report['phases'].items()):
+            lines.append('kernelci_deploy_phase_duration_seconds{} {}'.format(
+                metric_labels(phase=name), duration))
+        commands = {}
+        for cmd in report['commands']:
+            counts = commands.setdefault(cmd['phase'] or '', [0, 0, 0])
+            counts[0] += 1
+            counts[1] += 0 if cmd['status'] == 0 else 1
+            counts[2] += cmd['bytes'] or 0
+        for metric, index in [('commands_total', 0),
+                              ('command_failures_total', 1),
+                              ('command_output_bytes_total', 2)]:
+            lines.append('# TYPE kernelci_deploy_{} gauge'.format(metric))
+            for phase, counts in sorted(commands.items()):
+                lines.append('kernelci_deploy_{}{} {}'.format(
+                    metric, metric_labels(phase=phase), counts[index]))
+        tmp = '.'.join([path, str(os.getpid()), 'tmp'])
+        with open(tmp, 'w') as prom_file:
+            prom_file.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+
+    def write(self, json_path=None, prometheus_path=None, success=None):
+        self.write_json(json_path, success)
+        if prometheus_path:
+            self.write_prometheus(prometheus_path, success)
+
+
+# Report for the current run
+REPORT = RunReport()
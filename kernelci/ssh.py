@@ -0,0 +1,79 @@
+# Copyright (C) 2019 Collabora Limited
+# Author: Guillaume Tucker <guillaume.tucker@collabora.com>
+#
+# This module is free software; you can redistribute it and/or modify it under
+# the terms of the GNU Lesser General Public License as published by the Free
+# Software Foundation; either version 2.1 of the License, or (at your option)
+# any later version.
+#
+# This library is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU Lesser General Public License for more
+# details.
+#
+# You should have received a copy of the GNU Lesser General Public License
+# along with this library; if not, write to the Free Software Foundation, Inc.,
+# 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
+
+import os
+import re
+import shutil
+import subprocess
+import tempfile
+
+
+class SshSession:
+    """One ssh-agent and one shared SSH master connection per remote host
+
+    The agent is started and the key is loaded only once, then all the
+    commands run with the session environment go through the same SSH
+    connection until the session is closed.  The key is only kept for
+    `lifetime` seconds and the master connection exits `persist` seconds
+    after its last command, in case the session is never closed such as
+    when the process gets killed.
+    """
+
+    def __init__(self, ssh_key=None, lifetime=3600, persist=60):
+        self._tmp = tempfile.mkdtemp(prefix='kernelci-ssh-')
+        self._env = {
+            'GIT_SSH_COMMAND': ' '.join([
+                'ssh',
+                '-o ControlMaster=auto',
+                '-o ControlPath={}'.format(os.path.join(self._tmp, '%C')),
+                '-o ControlPersist={}'.format(persist),
+            ]),
+        }
+        self._agent_sock = os.path.join(self._tmp, 'agent')
+        self._agent = False
+        if ssh_key:
+            out = subprocess.check_output(
+                ['ssh-agent', '-s', '-a', self._agent_sock]).decode()
+            self._env.update(re.findall(
+                r'(SSH_AUTH_SOCK|SSH_AGENT_PID)=([^;]+);', out))
+            self._agent = True
+            try:
+                subprocess.check_call(
+                    ['ssh-add', '-t', str(lifetime), ssh_key], env=self.env)
+            except Exception:
+                self.close()
+                raise
+
+    @property
+    def env(self):
+        return dict(os.environ, **self._env)
+
+    def close(self):
+        if self._tmp is None:
+            return
+        for name in os.listdir(self._tmp):
+            control_path = os.path.join(self._tmp, name)
+            if control_path != self._agent_sock:
+                subprocess.run(
+                    ['ssh', '-o', 'ControlPath={}'.format(control_path),
+                     '-O', 'exit', 'kernelci'],
+                    stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if self._agent:
+            subprocess.run(['ssh-agent', '-k'], env=self.env,
+                           stdout=subprocess.DEVNULL)
+        shutil.rmtree(self._tmp, ignore_errors=True)
+        self._tmp = None
@@ -18,29 +18,81 @@
 # 51 Franklin Street, Fifth Floor, Boston, MA 02110-1301 USA
 
 import argparse
+import hashlib
+import io
 import json
 import os
 import subprocess
 import sys
+import threading
+import time
+import traceback
 
 import kernelci
-from kernelci import print_color, shell_cmd, ssh_agent
+import kernelci.pulls
+from kernelci import print_color
 
 
-def pull(args, pr, path):
-    branch = pr.head.ref
-    user = pr.head.repo.owner.login
+def pr_ref(pr):
+    return 'refs/staging/pull/{}'.format(pr.number)
+
+
+@kernelci.REPORT.phase('fetch', timed=False)
+def _fetch_fork(git, pr):
+    try:
+        git.run('fetch', '--quiet', '--no-write-fetch-head', pr.clone_url,
+                '+refs/heads/{}:{}'.format(pr.branch, pr_ref(pr)))
+    except subprocess.CalledProcessError:
+        return False
+    return True
+
+
+@kernelci.REPORT.phase('fetch')
+def fetch_prs(args, prs, path):
+    git = kernelci.git_repo(path)
+    local = set(pr.number for pr in prs if pr.sha and git.rev_parse(pr.sha))
+    git.update_refs(
+        'update {} {}'.format(pr_ref(pr), pr.sha)
+        for pr in prs if pr.number in local
+    )
+    remote = [pr for pr in prs if pr.number not in local]
+    if local:
+        print("Heads of {} PRs already present locally: {}".format(
+            len(local), ', '.join(str(number) for number in sorted(local))))
+    if remote:
+        try:
+            git.run('fetch', '--quiet', '--no-write-fetch-head', 'origin', *(
+                '+refs/pull/{}/head:{}'.format(pr.number, pr_ref(pr))
+                for pr in remote))
+        except subprocess.CalledProcessError:
+            print_color('yellow', "Failed to fetch PR heads from origin, \
+fetching from each fork")
+            thread_map(args.jobs, lambda pr: _fetch_fork(git, pr), remote)
+    return {pr.number: git.rev_parse(pr_ref(pr)) for pr in prs}
+
+
+def prune_pr_refs(path, prs):
+    git = kernelci.git_repo(path)
+    refs = set(pr_ref(pr) for pr in prs)
+    git.update_refs(
+        'delete {}'.format(ref) for ref in git.refs('refs/staging/pull/')
+        if ref not in refs
+    )
+
+
+@kernelci.REPORT.phase('merge')
+def merge(args, pr, sha, path):
+    git = kernelci.git_repo(path)
+    if sha is None:
+        print_color('yellow', "FAILED to fetch")
+        return False
     try:
-        shell_cmd("""\
-cd {path}
-git pull --quiet --no-ff --no-edit {origin} {branch}
-""".format(path=path, origin=pr.head.repo.clone_url, branch=branch))
+        git.run('merge', '--quiet', '--no-ff', '--no-edit', '-m',
+                "Merge branch '{}' of {}".format(pr.branch, pr.clone_url),
+                sha)
     except subprocess.CalledProcessError:
         print_color('yellow', "FAILED to pull")
-        shell_cmd("""\
-cd {path}
-git reset --merge
-""".format(path=path))
+        git.run('reset', '--merge')
         return False
     return True
 
@@ -54,29 +106,138 @@ def get_skip_list(args, settings):
     return skip
 
 
-def iterate_prs(repo, skip, users, path):
-    prs = repo.get_pulls()
-    for pr in reversed(list(prs)):
-        branch = pr.head.ref
-        repo = pr.head.repo
-        user = pr.head.repo.owner.login if repo else "(unknown)"
-        labels = list(label.name for label in pr.labels)
-        include_label = 'staging:{}'.format(args.main)
-        print("{:4} {:16} {:32} ".format(pr.number, user, branch), end='')
-        if repo is None:
-            print_color('red', "SKIP unknown repository")
-        elif user not in users:
-            print_color('red', "SKIP untrusted user")
-        elif (user, branch) in skip:
-            print_color('yellow', "SKIP")
-        elif args.skip_label and args.skip_label in labels:
-            print_color('yellow', "SKIP label: {}".format(args.skip_label))
-        elif pr.base.ref != args.main and include_label not in labels:
-            print_color('yellow', "SKIP base: {} labels: {}".format(pr.base.ref, labels))
+# The Github client is shared by all the projects but not thread-safe
+_GITHUB_LOCK = threading.Lock()
+
+
+def list_prs(args, repo_name):
+    if kernelci.GITHUB_TOKEN:
+        return kernelci.pulls.list_pulls_graphql(
+            repo_name, kernelci.GITHUB_TOKEN)
+    repo = kernelci.GITHUB.get_repo(repo_name)
+    return repo, kernelci.pulls.list_pulls_rest(repo)
+
+
+def print_pr(pr):
+    user = pr.user or "(unknown)"
+    print("{:4} {:16} {:32} ".format(pr.number, user, pr.branch), end='')
+
+
+def filter_prs(args, prs, skip, users):
+    include_label = 'staging:{}'.format(args.main)
+    selected = []
+    for pr in prs:
+        if pr.clone_url is None:
+            status = ('red', "SKIP unknown repository")
+        elif pr.user not in users:
+            status = ('red', "SKIP untrusted user")
+        elif (pr.user, pr.branch) in skip:
+            status = ('yellow', "SKIP")
+        elif args.skip_label and args.skip_label in pr.labels:
+            status = ('yellow', "SKIP label: {}".format(args.skip_label))
+        elif pr.base != args.main and include_label not in pr.labels:
+            status = ('yellow', "SKIP base: {} labels: {}".format(
+                pr.base, pr.labels))
+        else:
+            selected.append(pr)
+            continue
+        print_pr(pr)
+        print_color(*status)
+    return selected
+
+
+def staging_keys(base, prs, patches_path):
+    digest = hashlib.sha256(base.encode())
+    keys = []
+    for pr in prs:
+        digest.update('{}:{}\n'.format(pr.number, pr.sha).encode())
+        keys.append(digest.hexdigest())
+    digest.update(kernelci.patches_digest(patches_path).encode())
+    return keys, digest.hexdigest()
+
+
+def print_cached_prs(prs, flags, merged):
+    for pr in prs:
+        print_pr(pr)
+        merged[pr.number] = flags[str(pr.number)]
+        if merged[pr.number]:
+            print_color('green', "OK (cached)")
         else:
-            if pull(args, pr, path):
-                print_color('green', "OK")
+            print_color('yellow', "FAILED to merge (cached)")
+
+
+def _cached_commit(git, cache, key):
+    commit = (cache.get(key) or {}).get('commit')
+    return commit if commit and git.rev_parse(commit) else None
+
+
+@kernelci.REPORT.phase('prs')
+def iterate_prs(args, prs, path, cache, keys, merged):
+    git = kernelci.git_repo(path)
+    cached = 0
+    for key in keys:
+        if not _cached_commit(git, cache, key):
+            break
+        cached += 1
+    if cached:
+        git.run('reset', '--quiet', '--hard',
+                _cached_commit(git, cache, keys[cached - 1]))
+        print_cached_prs(prs[:cached], {
+            str(pr.number): cache.get(key)['merged']
+            for pr, key in zip(prs, keys[:cached])
+        }, merged)
+
+    # A PR which failed to fetch may be fetched on the next run, so nothing
+    # is cached from the first one onwards
+    cacheable = True
+    shas = fetch_prs(args, prs[cached:], path)
+    for pr, key in zip(prs[cached:], keys[cached:]):
+        print_pr(pr)
+        merged[pr.number] = merge(args, pr, shas[pr.number], path)
+        if merged[pr.number]:
+            print_color('green', "OK")
+        cacheable = cacheable and shas[pr.number] is not None
+        if cacheable:
+            cache.set(key, {
+                'commit': git.rev_parse('HEAD'),
+                'merged': merged[pr.number],
+            })
     print()
+    return cacheable
+
+
+def build_staging(args, prs, path, patches_path, merged):
+    git = kernelci.git_repo(path)
+    prune_pr_refs(path, prs)
+    cache = kernelci.JsonCache(
+        os.path.join(git.git_dir, 'kernelci-staging.json'))
+    keys, build_key = staging_keys(git.rev_parse('HEAD'), prs, patches_path)
+    if any(pr.sha is None for pr in prs):
+        cache = kernelci.JsonCache(None)
+
+    build = _cached_commit(git, cache, build_key)
+    flags = (cache.get(build_key) or {}).get('merged')
+    if build and flags is not None:
+        git.run('reset', '--quiet', '--hard', build)
+        print_cached_prs(prs, flags, merged)
+        print("\nReusing cached staging build: {}".format(build))
+        cache.save()
+        return True
+
+    try:
+        cacheable = iterate_prs(args, prs, path, cache, keys, merged)
+        if not kernelci.apply_patches(path, patches_path):
+            return False
+        build = git.rev_parse('HEAD')
+        if cacheable:
+            cache.set(build_key, {
+                'commit': build,
+                'merged': {str(number): ok for number, ok in merged.items()},
+            })
+        git.update_refs(['update refs/staging/build {}'.format(build)])
+    finally:
+        cache.save()
+    return True
 
 
 def do_push(args, settings, path, branch, ssh_key):
@@ -84,11 +245,10 @@ def do_push(args, settings, path, branch, ssh_key):
         print_color('red', "No destination branch provided.")
         return False
 
-    diff = kernelci.origin_diff(path, branch)
-    if not diff:
+    if not kernelci.origin_changed(path, branch):
         print_color('yellow', "No changes, not pushing.")
         return True
-    print(diff)
+    kernelci.print_origin_diff(path, branch, args.diffstat)
 
     tag = args.tag or kernelci.date_tag(path, args.tag_prefix)
     kernelci.create_tag(path, tag)
@@ -99,23 +259,144 @@ def do_push(args, settings, path, branch, ssh_key):
     return True
 
 
-def do_diff(path, branch):
-    diff = kernelci.origin_diff(path, branch)
-    if diff:
-        print(diff)
+@kernelci.REPORT.phase('prs')
+def build_staging_tree(args, prs, path, base, patches_path, merged):
+    git = kernelci.git_repo(path)
+    prune_pr_refs(path, prs)
+    shas = fetch_prs(args, prs, path)
+    head = base
+    for pr in prs:
+        print_pr(pr)
+        sha = shas[pr.number]
+        tree = git.merge_tree(head, sha) if sha else None
+        merged[pr.number] = tree is not None
+        if tree is None:
+            print_color('yellow', "FAILED to merge")
+            continue
+        msg = "Merge branch '{}' of {}".format(pr.branch, pr.clone_url)
+        head = git.commit_tree(tree, [head, sha], msg)
+        print_color('green', "OK")
+    print()
+
+    with kernelci.REPORT.phase('patches'):
+        with git.scratch_index(head) as env:
+            for patch in sorted(kernelci.find_patches(patches_path)):
+                print("Applying patch: {}".format(patch))
+                with open(patch, 'rb') as patch_file:
+                    patch_data = patch_file.read()
+                try:
+                    git.run('apply', '--cached', stdin=patch_data, env=env)
+                except subprocess.CalledProcessError:
+                    print("WARNING: Failed to apply patch")
+                    return None
+            return git.run('write-tree', env=env).strip()
+
+
+def do_diff(args, path, branch, tree):
+    if kernelci.origin_changed(path, branch, tree):
+        kernelci.print_origin_diff(path, branch, args.diffstat, tree)
         return True
     return False
 
 
-def main(args):
+def _trial_merge(git, base, first, second):
+    """Merge second on top of base, or of base and first when provided
+
+    Return None if first itself does not merge cleanly with base.
+    """
+    if first is not None:
+        tree = git.merge_tree(base, first)
+        if tree is None:
+            return None
+        base = git.commit_tree(tree, [base, first], "Trial merge")
+    return git.merge_tree(base, second) is not None
+
+
+@kernelci.REPORT.phase('conflicts')
+def find_conflicts(args, prs, path, base, merged):
+    """Find which PRs each failed PR conflicts with
+
+    Each failed PR is merged with the base branch alone and then with
+    every other PR in turn, all in the object database so this runs
+    after the staging branch has been built.  The result is a conflict
+    matrix with the PR numbers, or 'base' for PRs which conflict with
+    the base branch on their own.
+    """
+    failed = [pr for pr in prs if merged.get(pr.number) is False]
+    if not failed:
+        return {}
+    git = kernelci.git_repo(path)
+    fetch_prs(args, [pr for pr in prs if not git.rev_parse(pr_ref(pr))], path)
+    shas = {pr.number: git.rev_parse(pr_ref(pr)) for pr in prs}
+    numbers = set(pr.number for pr in failed)
+
+    trials = []
+    for pr in failed:
+        if not shas[pr.number]:
+            continue
+        trials.append((pr.number, None))
+        for other in prs:
+            if other.number == pr.number or not shas[other.number]:
+                continue
+            if other.number in numbers and other.number > pr.number:
+                continue
+            trials.append((pr.number, other.number))
+
+    @kernelci.REPORT.phase('conflicts', timed=False)
+    def run(trial):
+        number, other = trial
+        first = shas[other] if other else None
+        return _trial_merge(git, base, first, shas[number])
+
+    results = thread_map(args.jobs, run, trials)
+
+    conflicts = {pr.number: [] for pr in failed if shas[pr.number]}
+    for (number, other), clean in zip(trials, results):
+        if other is None and clean is False:
+            conflicts[number] = ['base']
+    for (number, other), clean in zip(trials, results):
+        if other is None or clean is not False:
+            continue
+        for pr_a, pr_b in [(number, other), (other, number)]:
+            if pr_a in conflicts and conflicts[pr_a] != ['base']:
+                conflicts[pr_a].append(pr_b)
+
+    print("Conflicts")
+    for pr in failed:
+        print_pr(pr)
+        if pr.number not in conflicts:
+            print_color('yellow', "not fetched")
+        elif not conflicts[pr.number]:
+            print_color('yellow', "no single PR, needs several of them")
+        else:
+            print_color('yellow', ', '.join(
+                str(other) for other in sorted(conflicts[pr.number])))
+    print()
+    kernelci.REPORT.set_item('conflicts', args.project, {
+        str(number): sorted(others)
+        for number, others in conflicts.items()
+    })
+    return conflicts
+
+
+def main(args, merged=None):
     settings = kernelci.Settings(args.settings, args.project)
     path = os.path.join('checkout', args.project)
     namespace = args.namespace or settings.get('namespace') or 'kernelci'
     repo_name = '/'.join([namespace, args.project])
-    repo = kernelci.GITHUB.get_repo(repo_name)
+    with kernelci.REPORT.phase('github'), _GITHUB_LOCK:
+        repo, prs = list_prs(args, repo_name)
     target_branch = args.branch or settings.get('branch') or ''
 
-    kernelci.checkout_repository(path, repo, branch=args.main)
+    if args.diff_only:
+        base = kernelci.fetch_repository(path, repo, branch=args.main,
+                                         cache_dir=args.cache_dir,
+                                         clone_filter=args.clone_filter,
+                                         checkout=False)
+    else:
+        kernelci.checkout_repository(path, repo, branch=args.main,
+                                     cache_dir=args.cache_dir,
+                                     clone_filter=args.clone_filter)
 
     skip = get_skip_list(args, settings)
 
@@ -127,34 +408,160 @@ def main(args):
         print_color('red', "Aborting, no list of trusted users")
         return False
 
-    iterate_prs(repo, skip, users, path)
-
+    prs = filter_prs(args, prs, skip, users)
     patches_path = os.path.join('patches', args.project, target_branch)
-    if not kernelci.apply_patches(path, patches_path):
-        print_color('red', "Aborting, all patches must apply.")
-        return False
 
-    if args.diff_only:
-        return do_diff(path, target_branch)
+    merged = {} if merged is None else merged
 
-    if args.push:
-        ssh_key = kernelci.default_ssh_key(args.ssh_key, target_branch)
-        if not ssh_key:
-            print_color('red', "No SSH key provided, cannot push.")
+    if args.diff_only:
+        tree = build_staging_tree(args, prs, path, base, patches_path, merged)
+        if tree is None:
+            print_color('red', "Aborting, all patches must apply.")
+            return False
+        ret = do_diff(args, path, target_branch, tree)
+    else:
+        base = kernelci.git_repo(path).rev_parse('HEAD')
+        if not build_staging(args, prs, path, patches_path, merged):
+            print_color('red', "Aborting, all patches must apply.")
             return False
 
-        if args.tag_limit:
-            kernelci.delete_old_tags(args, path, ssh_key)
-        do_push(args, settings, path, target_branch, ssh_key)
+        if args.push:
+            ssh_key = kernelci.default_ssh_key(args.ssh_key, target_branch)
+            if not ssh_key:
+                print_color('red', "No SSH key provided, cannot push.")
+                return False
+
+            if args.tag_limit:
+                kernelci.delete_old_tags(args, path, ssh_key)
+            do_push(args, settings, path, target_branch, ssh_key)
+        ret = True
+
+    if args.conflicts:
+        find_conflicts(args, prs, path, base, merged)
+
+    return ret
 
-    return True
+
+class ThreadStdout:
+    """Standard stream replacement writing to a buffer set for each thread"""
+
+    def __init__(self, stream):
+        self.stream = stream
+        self._local = threading.local()
+
+    @property
+    def buffer(self):
+        return getattr(self._local, 'buffer', None)
+
+    def capture(self, buf=None):
+        self._local.buffer = io.StringIO() if buf is None else buf
+        return self._local.buffer
+
+    def write(self, data):
+        buf = self.buffer
+        return (self.stream if buf is None else buf).write(data)
+
+    def flush(self):
+        if self.buffer is None:
+            self.stream.flush()
+
+
+def thread_map(jobs, func, items):
+    """Call func with each item in a thread pool
+
+    The worker threads write to the same buffers as the calling thread
+    when the standard streams have been replaced with ThreadStdout.
+    """
+    streams = [
+        (stream, stream.buffer) for stream in (sys.stdout, sys.stderr)
+        if isinstance(stream, ThreadStdout) and stream.buffer is not None
+    ]
+
+    def run(item):
+        for stream, buf in streams:
+            stream.capture(buf)
+        return func(item)
+
+    import concurrent.futures
+    with concurrent.futures.ThreadPoolExecutor(jobs) as executor:
+        return list(executor.map(run, items))
+
+
+def run_project(stdout, stderr, args):
+    output = stderr.capture(stdout.capture())
+    merged = {}
+    start = time.time()
+    try:
+        ret = main(args, merged)
+    except Exception:
+        traceback.print_exc(file=output)
+        ret = None
+    return {
+        'project': args.project,
+        'success': ret is True,
+        'status': {True: "OK", False: "FAILED", None: "ERROR"}.get(ret),
+        'duration': round(time.time() - start, 3),
+        'merged': sum(1 for ok in merged.values() if ok),
+        'failed': sum(1 for ok in merged.values() if not ok),
+        'output': output.getvalue(),
+    }
+
+
+def main_all(args):
+    projects = kernelci.Settings(args.settings, None).sections()
+    if not projects:
+        print_color('red', "No projects in {}".format(args.settings))
+        return False
+
+    # Each project's output is kept in memory until it is printed, so only
+    # the diffstat of the changes is shown rather than the whole diff
+    stdout = sys.stdout = ThreadStdout(sys.stdout)
+    stderr = sys.stderr = ThreadStdout(sys.stderr)
+    results = []
+    try:
+        import concurrent.futures
+        with concurrent.futures.ThreadPoolExecutor(args.jobs) as executor:
+            futures = [
+                executor.submit(run_project, stdout, stderr,
+                                argparse.Namespace(**dict(
+                                    vars(args), project=project,
+                                    diffstat=True)))
+                for project in projects
+            ]
+            for future in concurrent.futures.as_completed(futures):
+                res = future.result()
+                print("\n===== {} =====".format(res['project']))
+                print(res['output'], end='')
+                results.append(res)
+    finally:
+        sys.stdout = stdout.stream
+        sys.stderr = stderr.stream
+
+    results.sort(key=lambda res: projects.index(res['project']))
+    print("\n{:24} {:8} {:>6} {:>6} {:>10}".format(
+        "Project", "Status", "Merged", "Failed", "Time (s)"))
+    print("-------------------------------------------------------------")
+    for res in results:
+        print("{:24} ".format(res['project']), end='')
+        print_color('green' if res['success'] else 'red',
+                    "{:8} {:6} {:6} {:10.1f}".format(
+                        res['status'], res['merged'], res['failed'],
+                        res['duration']))
+        kernelci.REPORT.set_item('projects', res['project'], {
+            key: res[key]
+            for key in ['success', 'status', 'duration', 'merged', 'failed']
+        })
+    return all(res['success'] for res in results)
 
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser("\
 Create staging.kernelci.org branch with all pending PRs")
-    parser.add_argument("project",
+    parser.add_argument("project", nargs='?',
                         help="Name of the Github project")
+    parser.add_argument("--all", action="store_true",
+                        help="Build all the projects from the settings file \
+concurrently")
     parser.add_argument("--tag",
                         help="Tag to create, default is to use current date")
     parser.add_argument("--tag-prefix", default="staging-",
@@ -173,12 +580,43 @@ Create staging.kernelci.org branch with all pending PRs")
                         help="Name of a Github label used to skip PRs")
     parser.add_argument("--ssh-key",
                         help="Path to SSH key to push branches and tags")
+    parser.add_argument("--jobs", type=int, default=4,
+                        help="Number of concurrent fetches from forks, trial \
+merges and projects with --all")
+    parser.add_argument("--conflicts", action="store_true",
+                        help="Look for the PRs conflicting with the ones \
+which failed to merge")
+    parser.add_argument("--token",
+                        help="Github token to list PRs with one GraphQL query \
+and authenticate API requests, default is to use GITHUB_TOKEN if set")
     parser.add_argument("--push", action="store_true",
                         help="Push the resulting branch and tag")
     parser.add_argument("--diff-only", action="store_true",
-                        help="Return 1 if there is a difference with upstream")
+                        help="Return 1 if there is a difference with upstream, \
+computed without a working tree (needs git 2.38 or later)")
+    parser.add_argument("--cache-dir",
+                        help="Path to a shared git object cache")
+    parser.add_argument("--clone-filter",
+                        help="Partial clone filter, for example blob:none")
+    parser.add_argument("--diffstat", action="store_true",
+                        help="Only print the diffstat of the changes, \
+always the case with --all")
     parser.add_argument("--settings", default="data/staging.ini",
                         help="Path to a settings file")
+    parser.add_argument("--report",
+                        help="Path to write the JSON timing report to")
+    parser.add_argument("--prometheus",
+                        help="Path to write a Prometheus textfile report to")
     args = parser.parse_args(sys.argv[1:])
-    ret = main(args)
+    if bool(args.project) == args.all:
+        parser.error("either a project or --all is required")
+    if args.token:
+        kernelci.GITHUB_TOKEN = args.token
+    kernelci.REPORT.labels.update(
+        script='pending', project='all' if args.all else args.project)
+    ret = False
+    try:
+        ret = main_all(args) if args.all else main(args)
+    finally:
+        kernelci.REPORT.write(args.report, args.prometheus, ret is True)
     sys.exit(0 if ret is True else 1)
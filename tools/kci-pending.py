@@ -6,19 +6,34 @@ Poll pending PRs for project, verify if they match criteria and merge them
 import os
 import sys
 import json
+import hashlib
+import contextlib
 import requests
 import argparse
 import time
 import random
 import logging
 import tempfile
+import subprocess
 import configparser
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlparse, parse_qs
 
 PROJECT = 'kernelci'
 patch_files = []
 
 DEBUG=False
 
+# Largest number of conflicting PRs to search the best apply order for
+MAX_SEARCH_NODES = 24
+
+# Shared session, so all API requests reuse the same keep-alive connections
+session = requests.Session()
+
+# Records of the run report, one per PR, and durations of each phase
+pr_records = {}
+durations = {}
+
 # Set up logging, add colors
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
 logging.addLevelName(logging.INFO, "\033[1;32m%s\033[1;0m" % logging.getLevelName(logging.INFO))
@@ -28,18 +43,71 @@ logging.addLevelName(logging.DEBUG, "\033[1;34m%s\033[1;0m" % logging.getLevelNa
 
 
 def clone_repo(owner, args):
+    '''
+    Keep a persistent shallow clone of the repo: if it already exists,
+    fetch the latest default branch and reset the working tree to it in
+    place rather than cloning it again
+    '''
     url = f'https://github.com/{owner}/{args.repo}.git'
+    if args.push:
+        url = f'https://{args.push}@github.com/{owner}/{args.repo}'
+    if os.path.isdir(os.path.join(args.repo, '.git')):
+        logging.info(f'Updating existing clone of {args.repo}')
+        if not os.system(f'cd {args.repo} && git remote set-url origin {url} && '
+                         f'git fetch --quiet --depth 1 origin HEAD && '
+                         f'git reset --quiet --hard FETCH_HEAD && git clean -fdxq'):
+            return
+        logging.warning(f'Failed to update {args.repo}, cloning it again')
     if os.path.exists(args.repo):
         os.system(f'rm -rf {args.repo}')
-    os.system(f'git clone --depth 1 {url}')
+    os.system(f'git clone --depth 1 https://github.com/{owner}/{args.repo}.git')
     # if args.push then add push url
     if args.push:
         os.chdir(args.repo)
-        os.system(f'git remote set-url origin https://{args.push}@github.com/{owner}/{args.repo}')
+        os.system(f'git remote set-url origin {url}')
         os.chdir('..')
 
 
-def get_prs(owner, repo, token=None):
+def api_get(url, headers, params=None, cache_dir=None):
+    '''
+    GET request to the GitHub API, returns (status, text, links)
+    If cache_dir is set, responses with an ETag are stored there and sent
+    again with If-None-Match, a 304 reply is then served from the cache.
+    GitHub only exempts 304 replies from the rate limit for authorized
+    requests, so without a token this saves the payload but not the quota.
+    '''
+    entry = None
+    cache_file = None
+    if cache_dir:
+        key = json.dumps([url, params, headers.get('Accept'),
+                          hashlib.sha256(headers.get('Authorization', '').encode()).hexdigest()],
+                         sort_keys=True)
+        cache_file = os.path.join(cache_dir, hashlib.sha256(key.encode()).hexdigest() + '.json')
+        if os.path.exists(cache_file):
+            with open(cache_file) as f:
+                entry = json.load(f)
+            headers = dict(headers, **{'If-None-Match': entry['etag']})
+    response = session.get(url, headers=headers, params=params)
+    if response.status_code == 304 and entry:
+        logging.debug(f'Not modified: {response.url}')
+        return 200, entry['text'], entry['links']
+    links = {rel: link['url'] for rel, link in response.links.items()}
+    if cache_file and response.status_code == 200 and 'ETag' in response.headers:
+        os.makedirs(cache_dir, exist_ok=True)
+        tmp = f'{cache_file}.{os.getpid()}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump({'etag': response.headers['ETag'], 'text': response.text, 'links': links}, f)
+        os.replace(tmp, cache_file)
+    return response.status_code, response.text, links
+
+
+def get_prs(owner, repo, token=None, cache_dir=None, jobs=8):
+    '''
+    List all the open PRs, newest first, with 100 PRs per page
+    Once the first page gives the number of the last one, the other pages
+    are requested concurrently.  PRs opened or closed in the meantime shift
+    the pages, so a PR listed twice is only returned once.
+    '''
     url = f'https://api.github.com/repos/{owner}/{repo}/pulls'
     headers = {
         'Accept': 'application/vnd.github.v3+json',
@@ -48,14 +116,81 @@ def get_prs(owner, repo, token=None):
     if token:
         logging.debug(f'Using token for authentication')
         headers['Authorization'] = f'Bearer {token}'
-    response = requests.get(url, headers=headers)
-    if response.status_code != 200:
-        logging.error(f'Failed to fetch PRs for {owner}/{repo}: {response.status_code} {response.text}')
-        sys.exit(1)
-    return response.json()
+    params = {
+        'state': 'open',
+        'sort': 'created',
+        'direction': 'desc',
+        'per_page': 100,
+    }
+    pages = [api_get(url, headers, dict(params, page=1), cache_dir)]
+    last_page = 1
+    if 'last' in pages[0][2]:
+        last_page = int(parse_qs(urlparse(pages[0][2]['last']).query)['page'][0])
+    if last_page > 1:
+        with ThreadPoolExecutor(max_workers=jobs) as executor:
+            pages += executor.map(
+                lambda page: api_get(url, headers, dict(params, page=page), cache_dir),
+                range(2, last_page + 1))
+    prs = {}
+    for status, text, _ in pages:
+        if status != 200:
+            logging.error(f'Failed to fetch PRs for {owner}/{repo}: {status} {text}')
+            sys.exit(1)
+        for pr in json.loads(text):
+            prs.setdefault(pr['number'], pr)
+    prs = list(prs.values())
+    logging.info(f'Found {len(prs)} open PRs in {last_page} page(s)')
+    return prs
+
+
+def patch_cache_file(cache_dir, pr):
+    '''
+    Path of the cached patch of a PR, which only depends on the base repo,
+    the PR number and the head and base SHAs
+    '''
+    key = json.dumps([pr['base']['repo']['full_name'], pr['number'], pr['head']['sha'], pr['base']['sha']])
+    return os.path.join(cache_dir, 'patches', hashlib.sha256(key.encode()).hexdigest() + '.patch')
+
+
+def evict_patches(cache_dir, max_size):
+    '''
+    Remove the least recently used patches until the total size of the
+    patch cache is under max_size bytes
+    '''
+    path = os.path.join(cache_dir, 'patches')
+    if not os.path.isdir(path):
+        return
+    entries = []
+    for entry in os.scandir(path):
+        stat = entry.stat()
+        entries.append((stat.st_mtime, stat.st_size, entry.path))
+    total = sum(size for _, size, _ in entries)
+    for _, size, entry_path in sorted(entries):
+        if total <= max_size:
+            break
+        logging.debug(f'Evicting cached patch {entry_path}')
+        os.remove(entry_path)
+        total -= size
 
 
-def fetch_patch(pr, repo, token=None):
+def fetch_patch(pr, repo, token=None, retries=5, cache_dir=None):
+    '''
+    Download the patch of a PR, retrying with exponential backoff on
+    connection errors, rate limiting (429) and server errors (5xx)
+    If cache_dir is set, the patch is served from the cache when the PR
+    has not changed and stored there otherwise.
+    '''
+    start = time.time()
+    cache_file = patch_cache_file(cache_dir, pr) if cache_dir else None
+    if cache_file and os.path.exists(cache_file):
+        logging.info(f'Using cached patch for PR {pr["number"]}')
+        # the mtime is used to evict the least recently used patches
+        os.utime(cache_file)
+        with open(cache_file) as f:
+            patch = f.read()
+        record_pr(pr, fetch_time=round(time.time() - start, 6), cached=True,
+                  patch_size=len(patch.encode()))
+        return patch
     #url = pr['patch_url']
     #   https://api.github.com/repos/OWNER/REPO/pulls/123 \
     url = f'https://api.github.com/repos/{pr["base"]["repo"]["full_name"]}/pulls/{pr["number"]}'
@@ -69,7 +204,24 @@ def fetch_patch(pr, repo, token=None):
         logging.debug(f'Using token for authentication')
         headers['Authorization'] = f'Bearer {token}'
 
-    response = requests.get(url, headers=headers)
+    for attempt in range(retries + 1):
+        try:
+            response = session.get(url, headers=headers, timeout=60)
+        except requests.ConnectionError as e:
+            if attempt == retries:
+                raise
+            reason = str(e)
+            delay = None
+        else:
+            if response.status_code != 429 and response.status_code < 500:
+                break
+            if attempt == retries:
+                break
+            reason = response.status_code
+            delay = response.headers.get('Retry-After')
+        delay = float(delay) if delay else 2 ** attempt + random.random()
+        logging.warning(f'Failed to fetch patch for PR {pr["number"]} ({reason}), retrying in {delay:.1f}s')
+        time.sleep(delay)
     if DEBUG:
         # print headers in reply
         logging.debug(f'Headers: {response.headers}')
@@ -77,24 +229,163 @@ def fetch_patch(pr, repo, token=None):
     if response.status_code != 200:
         logging.error(f'Failed to fetch patch for PR {pr["number"]}: {response.status_code} {response.text}')
         sys.exit(1)
-    pfile = f'pr_{pr["number"]}.patch'
-    with open(pfile, 'w') as f:
-        f.write(response.text)
-    return pfile
+    if cache_file:
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        tmp = f'{cache_file}.{os.getpid()}.{pr["number"]}.tmp'
+        with open(tmp, 'w') as f:
+            f.write(response.text)
+        os.replace(tmp, cache_file)
+    record_pr(pr, fetch_time=round(time.time() - start, 6), cached=False,
+              patch_size=len(response.content))
+    return response.text
+
+
+def fetch_patches(prs, repo, token=None, jobs=8, cache_dir=None, cache_size=None):
+    '''
+    Download the patches of all the PRs concurrently, and write them to
+    pr_<n>.patch files in the order of the PRs
+    '''
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        patches = executor.map(lambda pr: fetch_patch(pr, repo, token, cache_dir=cache_dir), prs)
+        pfiles = []
+        for pr, patch in zip(prs, patches):
+            pfile = f'pr_{pr["number"]}.patch'
+            with open(pfile, 'w') as f:
+                f.write(patch)
+            pfiles.append(pfile)
+    if cache_dir and cache_size:
+        evict_patches(cache_dir, cache_size)
+    return pfiles
+
+
+def git(repo, *args, env=None):
+    return subprocess.run(['git', '-C', repo, *args], env=env,
+                          stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True)
+
+
+def start_series(repo, tmpdir):
+    '''
+    Start a series of patches applied to a temporary index, so the working
+    tree is only written once with the final result in finish_series()
+    '''
+    series = {
+        'head': git(repo, 'rev-parse', 'HEAD').stdout.strip(),
+        'env': dict(os.environ, GIT_INDEX_FILE=os.path.join(tmpdir, 'index')),
+    }
+    git(repo, 'read-tree', series['head'], env=series['env'])
+    return series
 
 
-def apply_patch(pr, repo, push=None):
-    # apply patch
-    if os.system(f'cd {repo} && git apply ../pr_{pr["number"]}.patch'):
+def apply_patch(pr, repo, series):
+    # apply patch to the series index, it is left unchanged if this fails
+    pfile = os.path.abspath(f'pr_{pr["number"]}.patch')
+    res = git(repo, 'apply', '--cached', pfile, env=series['env'])
+    if res.returncode:
         logging.error(f'Failed to apply patch for PR {pr["number"]}')
+        logging.debug(res.stderr)
         return False
     logging.info(f'Patch applied successfully')
-    # Add changes
-    os.system(f'cd {repo} && git add .')
-    # commit
-    os.system(f'cd {repo} && git commit -a -m "Staging PR {pr["number"]}"')
+    # commit the resulting tree on top of the series
+    tree = git(repo, 'write-tree', env=series['env']).stdout.strip()
+    res = git(repo, 'commit-tree', tree, '-p', series['head'],
+              '-m', f'Staging PR {pr["number"]}')
+    if res.returncode:
+        logging.error(f'Failed to commit PR {pr["number"]}: {res.stderr}')
+        sys.exit(1)
+    series['head'] = res.stdout.strip()
     return True
 
+
+def finish_series(repo, series):
+    # write the final tree to the working tree
+    if git(repo, 'reset', '--quiet', '--hard', series['head']).returncode:
+        logging.error('Failed to check out the staging commits')
+        sys.exit(1)
+
+
+def patch_paths(pfile):
+    paths = set()
+    with open(pfile) as f:
+        for line in f:
+            if line.startswith('diff --git '):
+                paths.update(path[2:] for path in line.split()[2:4])
+    return paths
+
+
+def max_independent_set(nodes, edges):
+    '''
+    Largest set of nodes with no edge between them, preferring the first
+    nodes when there are several solutions
+    The search is exponential, so with too many nodes they are taken in
+    order as long as they do not conflict with the ones already chosen.
+    '''
+    if len(nodes) > MAX_SEARCH_NODES:
+        best = []
+        for node in nodes:
+            if not edges[node] & set(best):
+                best.append(node)
+        return best
+
+    best = []
+
+    def search(chosen, remaining):
+        nonlocal best
+        if len(chosen) + len(remaining) <= len(best):
+            return
+        if not remaining:
+            best = chosen
+            return
+        node, rest = remaining[0], remaining[1:]
+        search(chosen + [node], [other for other in rest if other not in edges[node]])
+        search(chosen, rest)
+
+    search([], nodes)
+    return best
+
+
+def order_patches(repo, prs, pfiles, jobs=8):
+    '''
+    Choose the order to apply the patches in, to maximise the number of
+    PRs applied: every patch is checked against the base tree, then each
+    pair of patches touching the same files is checked for conflicts and
+    the largest set of PRs without conflicts between them goes first
+    '''
+    def check(pfile, env=None):
+        return git(repo, 'apply', '--check', '--cached', os.path.abspath(pfile), env=env).returncode == 0
+
+    def pair_conflicts(i):
+        if not pairs[i]:
+            return []
+        with tempfile.TemporaryDirectory() as tmpdir:
+            env = dict(os.environ, GIT_INDEX_FILE=os.path.join(tmpdir, 'index'))
+            git(repo, 'read-tree', 'HEAD', env=env)
+            git(repo, 'apply', '--cached', os.path.abspath(pfiles[i]), env=env)
+            return [j for j in pairs[i] if not check(pfiles[j], env)]
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        alone = list(executor.map(check, pfiles))
+        ok = [i for i in range(len(prs)) if alone[i]]
+        paths = {i: patch_paths(pfiles[i]) for i in ok}
+        pairs = {i: [j for j in ok if j > i and paths[i] & paths[j]] for i in ok}
+        edges = {i: set() for i in ok}
+        for i, conflicts in zip(ok, executor.map(pair_conflicts, ok)):
+            for j in conflicts:
+                edges[i].add(j)
+                edges[j].add(i)
+
+    for i in ok:
+        if edges[i]:
+            conflicts = sorted(prs[j]["number"] for j in edges[i])
+            logging.info(f'PR {prs[i]["number"]} conflicts with PRs {conflicts}')
+            record_pr(prs[i], conflicts=conflicts)
+    selected = max_independent_set([i for i in ok if edges[i]], edges)
+    first = [i for i in ok if not edges[i] or i in selected]
+    order = first + [i for i in range(len(prs)) if i not in first]
+    if order != list(range(len(prs))):
+        logging.info(f'Applying PRs in this order: {[prs[i]["number"] for i in order]}')
+    return [prs[i] for i in order], [pfiles[i] for i in order]
+
+
 def pr_tree_url(pr):
     repo_url = pr["head"]["repo"]["html_url"]
     sha = pr["head"]["sha"]
@@ -106,6 +397,45 @@ def pr_apply_tree_url(pr):
     return f'{repo_url}/tree/{sha}'
 
 
+@contextlib.contextmanager
+def timed(phase):
+    start = time.time()
+    try:
+        yield
+    finally:
+        durations[phase] = round(durations.get(phase, 0) + time.time() - start, 6)
+
+
+def record_pr(pr, **fields):
+    pr_records.setdefault(pr['number'], {'type': 'pr', 'pr': pr['number']}).update(fields)
+
+
+def write_report(path, args, start, success):
+    '''
+    Write the NDJSON run report: one record per PR followed by a summary
+    record of the run with the duration of each phase
+    '''
+    outcomes = [record.get('outcome') for record in pr_records.values()]
+    summary = {
+        'type': 'run',
+        'repo': f'{PROJECT}/{args.repo}',
+        'branch': args.branch,
+        'start': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(start)),
+        'success': success,
+        'durations': dict(durations, total=round(time.time() - start, 6)),
+        'prs': len(pr_records),
+        'applied': outcomes.count('applied'),
+        'failed': outcomes.count('error'),
+        'skipped': outcomes.count('skipped'),
+    }
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        for record in pr_records.values():
+            f.write(json.dumps(record, sort_keys=True) + '\n')
+        f.write(json.dumps(summary, sort_keys=True) + '\n')
+    os.replace(tmp, path)
+
+
 def log_pr_status(pr, state, reason=None):
     tree_url = pr_tree_url(pr)
     apply_tree_url = pr_apply_tree_url(pr)
@@ -122,6 +452,9 @@ def log_pr_status(pr, state, reason=None):
     if reason:
         payload['reason'] = reason
     logging.info(f'PR_STATUS {json.dumps(payload, sort_keys=True)}')
+    record_pr(pr, outcome=state, reason=reason)
+    if state == 'skipped':
+        record_pr(pr, decision='skipped')
 
 
 def save_pr_info(pr):
@@ -145,54 +478,76 @@ def read_users(filename):
     return users
 
 def merge_prs(args, users, token=None):
-    clone_repo(PROJECT, args)
-    prs = get_prs(PROJECT, args.repo, token)
-    for pr in prs:
-        #save_pr_info(pr)
-        logging.info(f'Checking PR {pr["number"]}: `{pr["title"]}` by {pr["user"]["login"]}')
-        if DEBUG:
-            print(f'PR: {pr}')
-        # Do not test PRs if they are updated more than 2 weeks ago
-        # 'updated_at': '2025-05-01T09:34:52Z'
-        updated_at_raw = pr["updated_at"]
-        updated_at = time.strptime(updated_at_raw, '%Y-%m-%dT%H:%M:%SZ')
-        two_weeks_ago = time.time() - (14 * 24 * 60 * 60)
-        if time.mktime(updated_at) < two_weeks_ago:
-            logging.info(f'Skipping PR {pr["number"]} as it was updated more than 2 weeks ago')
-            log_pr_status(pr, 'skipped', 'updated>2w')
-            continue
-        if not pr["user"]["login"].lower() in users:
-            logging.error(f'User {pr["user"]["login"]} not allowed to test PRs')
-            log_pr_status(pr, 'skipped', 'user-not-allowed')
-            continue
-        if not pr["labels"] or not 'staging-skip' in [label['name'] for label in pr["labels"]]:
-            logging.info(f'Processing PR {pr["number"]}')
-            pfile = fetch_patch(pr, args.repo, token)
-            patch_files.append(pfile)
-            if args.push:
-                applied = apply_patch(pr, args.repo, args.branch)
-            else:
-                applied = apply_patch(pr, args.repo)
-            if applied:
-                log_pr_status(pr, 'applied')
+    start = time.time()
+    success = False
+    try:
+        with timed('clone'):
+            clone_repo(PROJECT, args)
+        with timed('list'):
+            prs = get_prs(PROJECT, args.repo, token, args.cache_dir, args.jobs)
+        accepted = []
+        for pr in prs:
+            #save_pr_info(pr)
+            logging.info(f'Checking PR {pr["number"]}: `{pr["title"]}` by {pr["user"]["login"]}')
+            if DEBUG:
+                print(f'PR: {pr}')
+            # Do not test PRs if they are updated more than 2 weeks ago
+            # 'updated_at': '2025-05-01T09:34:52Z'
+            updated_at_raw = pr["updated_at"]
+            updated_at = time.strptime(updated_at_raw, '%Y-%m-%dT%H:%M:%SZ')
+            two_weeks_ago = time.time() - (14 * 24 * 60 * 60)
+            if time.mktime(updated_at) < two_weeks_ago:
+                logging.info(f'Skipping PR {pr["number"]} as it was updated more than 2 weeks ago')
+                log_pr_status(pr, 'skipped', 'updated>2w')
+                continue
+            if not pr["user"]["login"].lower() in users:
+                logging.error(f'User {pr["user"]["login"]} not allowed to test PRs')
+                log_pr_status(pr, 'skipped', 'user-not-allowed')
+                continue
+            if not pr["labels"] or not 'staging-skip' in [label['name'] for label in pr["labels"]]:
+                record_pr(pr, decision='accepted')
+                accepted.append(pr)
             else:
-                log_pr_status(pr, 'error', 'apply-failed')
-        else:
-            logging.info(f'Skipping PR {pr["number"]} due to staging-skip label')
-            log_pr_status(pr, 'skipped', 'staging-skip')
+                logging.info(f'Skipping PR {pr["number"]} due to staging-skip label')
+                log_pr_status(pr, 'skipped', 'staging-skip')
 
-    if args.push:
-        logging.info('Pushing changes to remote')
-        r = os.system(f'cd {args.repo} && git push origin HEAD:{args.branch} --force')
-        # if git failed - hard fail here
-        if r:
-            logging.error('Failed to push changes to remote')
-            sys.exit(1)
+        with timed('fetch'):
+            pfiles = fetch_patches(accepted, args.repo, token, args.jobs,
+                                   args.cache_dir, args.patch_cache_size * 1024 * 1024)
+        if not args.keep_order:
+            with timed('order'):
+                accepted, pfiles = order_patches(args.repo, accepted, pfiles, args.jobs)
+        with timed('apply'), tempfile.TemporaryDirectory() as tmpdir:
+            series = start_series(args.repo, tmpdir)
+            for pr, pfile in zip(accepted, pfiles):
+                logging.info(f'Processing PR {pr["number"]}')
+                patch_files.append(pfile)
+                apply_start = time.time()
+                applied = apply_patch(pr, args.repo, series)
+                record_pr(pr, apply_time=round(time.time() - apply_start, 6))
+                if applied:
+                    log_pr_status(pr, 'applied')
+                else:
+                    log_pr_status(pr, 'error', 'apply-failed')
+            finish_series(args.repo, series)
 
+        if args.push:
+            logging.info('Pushing changes to remote')
+            with timed('push'):
+                r = os.system(f'cd {args.repo} && git push origin HEAD:{args.branch} --force')
+            # if git failed - hard fail here
+            if r:
+                logging.error('Failed to push changes to remote')
+                sys.exit(1)
 
-        logging.info('Changes pushed to remote')
-    else:
-        logging.info('Changes not pushed to remote')
+
+            logging.info('Changes pushed to remote')
+        else:
+            logging.info('Changes not pushed to remote')
+        success = True
+    finally:
+        if args.report:
+            write_report(args.report, args, start, success)
 
 
 def main():
@@ -205,7 +560,18 @@ def main():
     parser.add_argument('--userlist', help='File with users allowed to test PRs', default='../data/staging.ini')
     parser.add_argument('--debug', action='store_true', help='Enable debug mode')
     parser.add_argument('--token', help='GitHub token for authentication')
+    parser.add_argument('--cache-dir', help='Directory to cache GitHub API responses with their ETag',
+                        default='.kci-pending-cache')
+    parser.add_argument('--patch-cache-size', type=int, default=256,
+                        help='Maximum size of the patch cache in MB, least recently used patches are removed first')
+    parser.add_argument('--keep-order', action='store_true',
+                        help='Apply the PRs in the order they are listed, without checking for conflicts first')
+    parser.add_argument('--report', help='File to write the NDJSON run report to')
+    parser.add_argument('--jobs', type=int, default=8,
+                        help='Number of concurrent GitHub API requests and patch downloads')
     args = parser.parse_args()
+    # keep one pooled connection per concurrent request
+    session.mount('https://', requests.adapters.HTTPAdapter(pool_maxsize=args.jobs))
     token = None
     if args.token:
         token = args.token
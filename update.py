@@ -22,23 +22,21 @@ import os
 import sys
 
 import kernelci
-from kernelci import print_color, shell_cmd, ssh_agent
+from kernelci import print_color
 
 
+@kernelci.REPORT.phase('rebase')
 def do_rebase(path, origin='origin', origin_branch='main'):
-    shell_cmd("""\
-cd {path}
-git pull --rebase {origin} {origin_branch}
-git push 'origin' HEAD:{origin_branch} --force
-""".format(path=path, origin=origin, origin_branch=origin_branch))
+    git = kernelci.git_repo(path)
+    git.run('pull', '--rebase', origin, origin_branch)
+    git.run('push', 'origin', 'HEAD:{}'.format(origin_branch), '--force')
 
 
-def do_push(path, ssh_key, tag, branch):
-    diff = kernelci.origin_diff(path, branch)
-    if not diff:
+def do_push(path, ssh_key, tag, branch, diffstat=False):
+    if not kernelci.origin_changed(path, branch):
         print_color('yellow', "No changes, not pushing.")
         return True
-    print(diff)
+    kernelci.print_origin_diff(path, branch, diffstat)
 
     kernelci.create_tag(path, tag)
 
@@ -48,9 +46,12 @@ def do_push(path, ssh_key, tag, branch):
 
 def main(args):
     repo_name = '/'.join([args.namespace, args.project])
-    repo = kernelci.GITHUB.get_repo(repo_name)
+    with kernelci.REPORT.phase('github'):
+        repo = kernelci.GITHUB.get_repo(repo_name)
     path = os.path.join('checkout', args.project)
-    kernelci.checkout_repository(path, repo, branch=args.branch)
+    kernelci.checkout_repository(path, repo, branch=args.branch,
+                                 cache_dir=args.cache_dir,
+                                 clone_filter=args.clone_filter)
 
     do_rebase(path, args.origin, args.origin_branch)
 
@@ -61,7 +62,7 @@ def main(args):
             return False
 
         tag = args.tag or kernelci.date_tag(path, args.tag_prefix)
-        do_push(path, ssh_key, tag, args.branch)
+        do_push(path, ssh_key, tag, args.branch, args.diffstat)
 
     return True
 
@@ -83,10 +84,30 @@ Update kernelci.org branch with latest changes")
                         help="Name of the branch in the origin to rebase onto")
     parser.add_argument("--namespace", default='kernelci',
                         help="Github project namespace, default is kernelci")
+    parser.add_argument("--token",
+                        help="Github token to authenticate API requests, \
+default is to use GITHUB_TOKEN if set")
     parser.add_argument("--ssh-key",
                         help="Path to SSH key to push branches and tags")
+    parser.add_argument("--cache-dir",
+                        help="Path to a shared git object cache")
+    parser.add_argument("--clone-filter",
+                        help="Partial clone filter, for example blob:none")
+    parser.add_argument("--diffstat", action="store_true",
+                        help="Only print the diffstat of the changes")
     parser.add_argument("--push", action="store_true",
                         help="Push the resulting branch and tag")
+    parser.add_argument("--report",
+                        help="Path to write the JSON timing report to")
+    parser.add_argument("--prometheus",
+                        help="Path to write a Prometheus textfile report to")
     args = parser.parse_args(sys.argv[1:])
-    ret = main(args)
+    if args.token:
+        kernelci.GITHUB_TOKEN = args.token
+    kernelci.REPORT.labels.update(script='update', project=args.project)
+    ret = False
+    try:
+        ret = main(args)
+    finally:
+        kernelci.REPORT.write(args.report, args.prometheus, ret is True)
     sys.exit(0 if ret is True else 1)